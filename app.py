@@ -3,40 +3,72 @@
 from stacks.back_end.serverless_sqs_consumer_stack.serverless_sqs_consumer_stack import ServerlessSqsConsumerStack
 from stacks.back_end.serverless_sqs_producer_stack.serverless_sqs_producer_stack import ServerlessSqsProducerStack
 from stacks.back_end.serverless_sqs_retry_stack.serverless_sqs_retry_stack import ServerlessSqsRetryStack
+from stacks.back_end.queue_topology import get_queue_topology
 
 from aws_cdk import core
 
 app = core.App()
 
+# Fault & latency injection for load testing, Shared by all the stages
+fault_injection_profile = app.node.try_get_context("fault_injection") or {}
+
+# Delays, timeouts, batch sizes & retry limits of the queues, Shared with `tools/topology_sim.py`
+queue_topology = get_queue_topology(
+    app.node.try_get_context("queue_topology"))
+
 
 # Produce message events and ingest into SQS queue
 sqs_message_producer_stack = ServerlessSqsProducerStack(
     app,
     f"{app.node.try_get_context('project')}-producer-stack",
     stack_log_level="INFO",
+    fault_injection_profile=fault_injection_profile,
+    queue_topology=queue_topology,
+    shard_cnt=int(app.node.try_get_context("shard_cnt") or 1),
+    store_cnt=int(app.node.try_get_context("store_cnt") or 100),
+    pack_records=str(app.node.try_get_context("pack_records")).lower() == "true",
     description="Miztiik Automation: Produce message events and ingest into SQS queue"
 )
 
-# Consume messages from SQS
-reliable_message_queue_stack = ServerlessSqsConsumerStack(
-    app,
-    f"{app.node.try_get_context('project')}-consumer-stack",
-    stack_log_level="INFO",
-    reliable_queue=sqs_message_producer_stack.get_queue,
-    max_msg_receive_cnt=sqs_message_producer_stack.max_msg_receive_cnt,
-    description="Miztiik Automation: Consume messages from SQS"
-)
+# Consumers & retries are per shard, so that replays go back to the shard of the message
+for shard, shard_queues in enumerate(sqs_message_producer_stack.get_shards):
+    shard_sfx = f"-shard-{shard}" if shard else ""
 
-# Replay Messages in DLQ back to main queue with exponential backoff
-reliable_message_dlq_replay_stack = ServerlessSqsRetryStack(
-    app,
-    f"{app.node.try_get_context('project')}-stack",
-    stack_log_level="INFO",
-    reliable_queue=sqs_message_producer_stack.get_queue,
-    reliable_queue_dlq=sqs_message_producer_stack.get_dlq,
-    max_msg_receive_cnt=sqs_message_producer_stack.max_msg_receive_cnt,
-    description="Miztiik Automation: Replay Messages in DLQ back to main queue with exponential backoff"
-)
+    # Consume messages from SQS
+    reliable_message_queue_stack = ServerlessSqsConsumerStack(
+        app,
+        f"{app.node.try_get_context('project')}-consumer-stack{shard_sfx}",
+        stack_log_level="INFO",
+        priority_lanes=shard_queues["lanes"],
+        lane_weights=queue_topology["lane_weights"],
+        retry_queue=shard_queues["retry"],
+        dead_letter_queue=shard_queues["dlq"],
+        expired_queue=sqs_message_producer_stack.get_expired_q,
+        default_msg_ttl_secs=queue_topology["default_msg_ttl_secs"],
+        results_table=sqs_message_producer_stack.get_results_table,
+        pipeline_utils_layer=sqs_message_producer_stack.get_pipeline_utils_layer,
+        fault_injection_profile=fault_injection_profile,
+        queue_topology=queue_topology,
+        max_msg_receive_cnt=sqs_message_producer_stack.max_msg_receive_cnt,
+        description="Miztiik Automation: Consume messages from SQS"
+    )
+
+    # Replay Messages in DLQ back to the replay lane with exponential backoff
+    reliable_message_dlq_replay_stack = ServerlessSqsRetryStack(
+        app,
+        f"{app.node.try_get_context('project')}-stack{shard_sfx}",
+        stack_log_level="INFO",
+        reliable_queue=shard_queues["lanes"]["replay"],
+        reliable_queue_dlq=shard_queues["retry"],
+        dead_letter_queue=shard_queues["dlq"],
+        expired_queue=sqs_message_producer_stack.get_expired_q,
+        default_msg_ttl_secs=queue_topology["default_msg_ttl_secs"],
+        pipeline_utils_layer=sqs_message_producer_stack.get_pipeline_utils_layer,
+        fault_injection_profile=fault_injection_profile,
+        queue_topology=queue_topology,
+        max_msg_receive_cnt=sqs_message_producer_stack.max_msg_receive_cnt,
+        description="Miztiik Automation: Replay Messages in DLQ back to main queue with exponential backoff"
+    )
 
 
 # Stack Level Tagging
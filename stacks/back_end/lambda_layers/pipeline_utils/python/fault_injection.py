@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import random
+import time
+
+from botocore.exceptions import ClientError
+
+
+"""
+.. module: fault_injection
+    :Actions: Inject failures, latency & throttling into the pipeline stages for load testing
+    :copyright: (c) 2021 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "fault_injection"
+    FAULT_INJECTION_PROFILE = os.getenv("FAULT_INJECTION_PROFILE", "{}")
+
+
+class FaultInjectedError(Exception):
+    def __init__(self, stage, op, msg=None):
+        if msg is None:
+            msg = "Injected failure at stage(%s) during %s" % (stage, op)
+        super(FaultInjectedError, self).__init__(msg)
+        self.stage = stage
+        self.op = op
+
+
+class FaultInjector:
+    """
+    Inject faults into one stage(`produce`, `consume`, `replay`) of the pipeline.
+
+    The profile is shared by all the stages & looks like,
+        {
+            "enabled": true,
+            "seed": 42,
+            "stages": {
+                "produce": {"bad_msg_pct": 10},
+                "consume": {
+                    "failure_pct": 5,
+                    "throttle_pct": 1,
+                    "latency": {"dist": "lognormal", "median_ms": 20, "sigma": 1, "max_ms": 2000}
+                }
+            }
+        }
+
+    Latency distributions are `fixed`(ms), `uniform`(min_ms, max_ms),
+    `exponential`(mean_ms) & `lognormal`(median_ms, sigma). An optional `pct`
+    applies the latency only to that share of the calls. With a `seed`, every
+    stage replays the same sequence of faults on each cold start.
+    """
+
+    LATENCY_DISTS = {
+        "fixed": lambda rng, l: l["ms"],
+        "uniform": lambda rng, l: rng.uniform(l["min_ms"], l["max_ms"]),
+        "exponential": lambda rng, l: rng.expovariate(1 / l["mean_ms"]),
+        "lognormal": lambda rng, l: l["median_ms"] * rng.lognormvariate(0, l.get("sigma", 1)),
+    }
+
+    def __init__(self, stage, profile=None):
+        profile = profile or {}
+        self.stage = stage
+        self.enabled = profile.get("enabled", True) is True
+        self.cfg = profile.get("stages", {}).get(stage, {}) if self.enabled else {}
+        seed = profile.get("seed")
+        self.rng = random.Random(f"{seed}:{stage}") if seed is not None else random.Random()
+        self.reset_stat()
+
+    def reset_stat(self):
+        """ Injectors live across warm invocations, Reset at the start of each one to report per invocation """
+        self.stat = {"failures": 0, "throttles": 0, "bad_msgs": 0, "latency_ms": 0}
+
+    @classmethod
+    def from_env(cls, stage):
+        return cls(stage, json.loads(GlobalArgs.FAULT_INJECTION_PROFILE or "{}"))
+
+    def _roll(self, pct):
+        return pct > 0 and self.rng.random() * 100 < pct
+
+    def bad_msg(self):
+        """ Should the next message be produced without its mandatory attributes """
+        r = self._roll(self.cfg.get("bad_msg_pct", 0))
+        self.stat["bad_msgs"] += r
+        return r
+
+    def latency_ms(self):
+        l = self.cfg.get("latency")
+        if not l or not self._roll(l.get("pct", 100)):
+            return 0
+        ms = max(0, self.LATENCY_DISTS[l["dist"]](self.rng, l))
+        return min(ms, l.get("max_ms", ms))
+
+    def inject(self, op):
+        """ Call before the operation `op`, Might sleep, raise a throttling `ClientError` or a `FaultInjectedError` """
+        if not self.cfg:
+            return
+        ms = self.latency_ms()
+        if ms:
+            self.stat["latency_ms"] += ms
+            time.sleep(ms / 1000)
+        if self._roll(self.cfg.get("throttle_pct", 0)):
+            self.stat["throttles"] += 1
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": f"Rate exceeded, Injected at stage({self.stage})"}},
+                op
+            )
+        if self._roll(self.cfg.get("failure_pct", 0)):
+            self.stat["failures"] += 1
+            raise FaultInjectedError(self.stage, op)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+
+"""
+.. module: msg_envelope
+    :Actions: Pack many small records into one SQS message & unpack them again
+    :copyright: (c) 2021 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "msg_envelope"
+    ENVELOPE_FMT = "envelope_v1"
+    # SQS messages are limited to 256KB, including the attributes
+    MAX_ENVELOPE_BYTES = 250 * 1024
+
+
+# An envelope is the body of an SQS message, with the message attribute `msg_fmt` set to `envelope_v1`,
+#   {"envelope_v": 1, "records": [{"id": "..", "body": "..", "attrs": {"store_id": "3"}}]}
+# Unpacked records look like the records of an SQS event, so the consumer treats them like plain messages.
+
+
+def is_envelope(m_attr):
+    """ Works with both, the event(`stringValue`) & the `send_message`(`StringValue`) attribute shapes """
+    fmt = m_attr.get("msg_fmt", {})
+    return (fmt.get("stringValue") or fmt.get("StringValue")) == GlobalArgs.ENVELOPE_FMT
+
+
+def envelope_attrs(record_cnt, msg_attr=None):
+    """ Message attributes(`send_message` shape) of an envelope holding `record_cnt` records """
+    attrs = dict(msg_attr or {})
+    attrs["msg_fmt"] = {"DataType": "String",
+                        "StringValue": GlobalArgs.ENVELOPE_FMT}
+    attrs["record_cnt"] = {"DataType": "Number",
+                           "StringValue": f"{record_cnt}"}
+    return attrs
+
+
+def to_record(m):
+    """ An (unpacked) event record back to an envelope record """
+    return {
+        "id": m.get("recordId", m.get("messageId")),
+        "body": m["body"],
+        "attrs": {
+            k: v["stringValue"] for k, v in m.get("messageAttributes", {}).items()
+            if v.get("stringValue") is not None
+        }
+    }
+
+
+def unpack(m):
+    """ Records of the envelope in the event record `m`, shaped like event records """
+    records = []
+    for r in json.loads(m["body"])["records"]:
+        records.append({
+            "messageId": r["id"],
+            "recordId": r["id"],
+            "envelopeId": m.get("messageId"),
+            "envelopeAttributes": m.get("messageAttributes", {}),
+            "receiptHandle": m.get("receiptHandle"),
+            "body": r["body"],
+            "messageAttributes": {
+                k: {"stringValue": v, "dataType": "String"} for k, v in r.get("attrs", {}).items()
+            }
+        })
+    return records
+
+
+class EnvelopePacker:
+    """
+    Pack records into envelopes of at most `max_bytes`.
+
+    `add` returns the envelope that had to be closed to fit the new record,
+    `flush` closes the open envelope. Use `age_secs` to bound how long a
+    record waits in an open envelope.
+    """
+
+    HEADER_BYTES = len(json.dumps({"envelope_v": 1, "records": []}))
+
+    def __init__(self, max_bytes=GlobalArgs.MAX_ENVELOPE_BYTES):
+        self.max_bytes = max_bytes
+        self.records = []
+        self._size = self.HEADER_BYTES
+        self._opened_at = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def age_secs(self):
+        """ How long the open envelope has been waiting for records """
+        return time.monotonic() - self._opened_at if self.records else 0
+
+    def add(self, rec):
+        # Each record adds a ", " separator in the list
+        rec_size = len(json.dumps(rec).encode("utf-8")) + 2
+        if self.HEADER_BYTES + rec_size > self.max_bytes:
+            raise ValueError(
+                f"Record({rec.get('id')}) of {rec_size} bytes does not fit in an envelope of {self.max_bytes} bytes")
+        closed = None
+        if self.records and self._size + rec_size > self.max_bytes:
+            closed = self.flush()
+        if not self.records:
+            self._opened_at = time.monotonic()
+        self.records.append(rec)
+        self._size += rec_size
+        return closed
+
+    def flush(self):
+        if not self.records:
+            return None
+        body = json.dumps({"envelope_v": 1, "records": self.records})
+        self.records = []
+        self._size = self.HEADER_BYTES
+        return body
+
+
+def pack(records, max_bytes=GlobalArgs.MAX_ENVELOPE_BYTES):
+    """ Pack all the records, Returns `(body, record_cnt)` for every envelope """
+    packer = EnvelopePacker(max_bytes)
+    envelopes = []
+    for rec in records:
+        cnt = len(packer)
+        closed = packer.add(rec)
+        if closed:
+            envelopes.append((closed, cnt))
+    cnt = len(packer)
+    closed = packer.flush()
+    if closed:
+        envelopes.append((closed, cnt))
+    return envelopes
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+
+"""
+.. module: msg_routing
+    :Actions: Route messages to shards & pick the priority lane to poll next
+    :copyright: (c) 2021 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "msg_routing"
+
+
+def shard_for(partition_key, shard_cnt):
+    """ Stable across invocations & runtimes, unlike the salted `hash()` """
+    return zlib.crc32(partition_key.encode("utf-8")) % shard_cnt
+
+
+class WeightedLaneScheduler:
+    """
+    Smooth weighted round robin across priority lanes.
+
+    Each lane is picked in proportion to its weight and at least once every
+    `sum(weights)` turns, so the low priority lanes never starve. Lanes that
+    are skipped(found empty) hand over their share to the busy ones.
+    """
+
+    def __init__(self, weights):
+        self.weights = {l: w for l, w in weights.items() if w > 0}
+        self._current = dict.fromkeys(self.weights, 0)
+
+    def next_lane(self, skip=()):
+        lanes = [l for l in self.weights if l not in skip]
+        if not lanes:
+            return None
+        for l in lanes:
+            self._current[l] += self.weights[l]
+        lane = max(lanes, key=lambda l: self._current[l])
+        self._current[lane] -= sum(self.weights[l] for l in lanes)
+        return lane
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+
+
+"""
+.. module: msg_ttl
+    :Actions: Age & expiry of messages, from the `ts` & `ttl_secs` attributes set by the producer
+    :copyright: (c) 2021 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "msg_ttl"
+
+
+def _attr(m, name):
+    return m.get("messageAttributes", {}).get(name, {}).get("stringValue")
+
+
+def msg_age_secs(m, now):
+    """ Age from the `ts` attribute, Falls back to the `evnt_time` in the body, `None` if neither can be read """
+    try:
+        return now - int(_attr(m, "ts"))
+    except (ValueError, TypeError):
+        pass
+    try:
+        evnt_time = json.loads(m["body"]).get("evnt_time")
+        return now - datetime.datetime.fromisoformat(evnt_time).timestamp()
+    except (ValueError, TypeError, AttributeError, KeyError):
+        return None
+
+
+def is_expired(m, now, default_ttl_secs=0):
+    """ A TTL of `0` or less never expires, Messages of unknown age are never expired either """
+    try:
+        ttl = int(_attr(m, "ttl_secs"))
+    except (ValueError, TypeError):
+        ttl = default_ttl_secs
+    if ttl <= 0:
+        return False
+    age = msg_age_secs(m, now)
+    return age is not None and age > ttl
@@ -0,0 +1,46 @@
+import copy
+
+
+# Knobs of the queue topology, shared by the stacks & the capacity planning simulator(`tools/topology_sim.py`)
+# Override any of them under `queue_topology` in the `cdk.json` context
+DEFAULT_QUEUE_TOPOLOGY = {
+    # Receives before a message is redriven, from the lanes to the retry queue & from the retry queue to the DLQ
+    "max_msg_receive_cnt": 5,
+    "max_msg_receive_cnt_at_retry": 3,
+    "visibility_timeout_secs": 10,
+    "receive_message_wait_secs": 10,
+    "message_retention_secs": 172800,
+    "delivery_delay_secs": {
+        "normal": 5,
+        "high": 0,
+        "replay": 0,
+        "retry": 10,
+        "dlq": 100
+    },
+    # Lanes consumed by an SQS event source as soon as messages arrive, The scheduled consumer polls
+    # the other lanes with weighted round robin
+    "event_source_lanes": ["high"],
+    "lane_weights": {"high": 6, "normal": 3, "replay": 1},
+    "consumer_batch_size": 5,
+    "consumer_timeout_secs": 55,
+    # EventBridge schedules are in whole minutes
+    "consumer_schedule_mins": 1,
+    # The retry lambda replays with exponential backoff & full jitter
+    "retry_batch_size": 1,
+    "max_attempts": 3,
+    "backoff_rate": 2,
+    "default_msg_ttl_secs": 86400,
+    "high_priority_pct": 20,
+    "high_priority_msg_ttl_secs": 300
+}
+
+
+def get_queue_topology(overrides=None, base=DEFAULT_QUEUE_TOPOLOGY):
+    """ The `base` topology updated with `overrides`, Nested dicts are updated key by key """
+    topology = copy.deepcopy(base)
+    for k, v in (overrides or {}).items():
+        if isinstance(v, dict) and isinstance(topology.get(k), dict):
+            topology[k].update(v)
+        else:
+            topology[k] = v
+    return topology
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+
+
+"""
+.. module: result_sinks
+    :Actions: Buffer the results of processed messages & write them downstream in bulk
+    :copyright: (c) 2021 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "result_sinks"
+    # `dynamodb:<table_name>`, `sqlite:<db_path>` or `file:<jsonl_path>`, Empty disables the sink
+    RESULT_SINK = os.getenv("RESULT_SINK", "")
+    SINK_MAX_RETRIES = int(os.getenv("SINK_MAX_RETRIES", 3))
+    SINK_BACKOFF_BASE_MS = int(os.getenv("SINK_BACKOFF_BASE_MS", 50))
+    SINK_BACKOFF_CAP_MS = int(os.getenv("SINK_BACKOFF_CAP_MS", 1000))
+
+
+LOG = logging.getLogger()
+
+
+class BufferedSink:
+    """
+    Buffer results & write them in chunks of `chunk_size`.
+
+    Every result is `put` with the `messageId` of its source record. Full
+    chunks are written right away, `flush` writes the rest & returns the
+    `messageId`s of every result that could not be written since the last
+    flush, so the caller can report just those as failed. Subclasses write a
+    chunk in `_write` & return the entries that were not written.
+    """
+
+    chunk_size = 100
+
+    def __init__(self):
+        self._buf = []
+        self._failed_ids = []
+        self.stat = {"puts": 0, "writes": 0, "retries": 0, "failed": 0}
+
+    def put(self, msg_id, item):
+        self._buf.append((msg_id, item))
+        self.stat["puts"] += 1
+        if len(self._buf) >= self.chunk_size:
+            self._write_buf()
+
+    def flush(self):
+        self._write_buf()
+        failed_ids, self._failed_ids = self._failed_ids, []
+        return failed_ids
+
+    def _write_buf(self):
+        while self._buf:
+            chunk, self._buf = self._buf[:self.chunk_size], self._buf[self.chunk_size:]
+            try:
+                failed = self._write(chunk)
+            except Exception as e:
+                LOG.exception(f"ERROR:{str(e)}")
+                failed = chunk
+            self.stat["writes"] += 1
+            self.stat["failed"] += len(failed)
+            self._failed_ids.extend(msg_id for msg_id, _ in failed)
+
+    def _write(self, chunk):
+        raise NotImplementedError
+
+
+class DynamoDbSink(BufferedSink):
+    """
+    `BatchWriteItem` results into a table keyed by `msg_id`.
+
+    `UnprocessedItems` are retried with full jitter backoff, whatever is left
+    after `max_retries` is mapped back to its `messageId` through the key.
+    """
+
+    # `BatchWriteItem` takes at most 25 items
+    chunk_size = 25
+
+    def __init__(self, table_name, client=None, max_retries=GlobalArgs.SINK_MAX_RETRIES):
+        super(DynamoDbSink, self).__init__()
+        self.table_name = table_name
+        self.client = client or boto3.client("dynamodb")
+        self.max_retries = max_retries
+        self._ser = TypeSerializer()
+
+    def _backoff(self, n):
+        cap = min(GlobalArgs.SINK_BACKOFF_CAP_MS,
+                  GlobalArgs.SINK_BACKOFF_BASE_MS * 2 ** n)
+        time.sleep(random.uniform(0, cap) / 1000)
+
+    def _write(self, chunk):
+        by_id = {msg_id: (msg_id, item) for msg_id, item in chunk}
+        reqs = [
+            {"PutRequest": {"Item": {k: self._ser.serialize(v) for k, v in dict(item, msg_id=msg_id).items()}}}
+            for msg_id, item in chunk
+        ]
+        for n in range(self.max_retries + 1):
+            if n:
+                self.stat["retries"] += 1
+                self._backoff(n)
+            resp = self.client.batch_write_item(
+                RequestItems={self.table_name: reqs})
+            reqs = resp.get("UnprocessedItems", {}).get(self.table_name, [])
+            if not reqs:
+                return []
+        return [by_id[r["PutRequest"]["Item"]["msg_id"]["S"]] for r in reqs]
+
+
+class SqliteSink(BufferedSink):
+    """ For local runs, One transaction per chunk """
+
+    chunk_size = 500
+
+    def __init__(self, db_path):
+        super(SqliteSink, self).__init__()
+        self.db = sqlite3.connect(db_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results (msg_id TEXT PRIMARY KEY, item TEXT NOT NULL)")
+
+    def _write(self, chunk):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO results (msg_id, item) VALUES (?, ?)",
+                [(msg_id, json.dumps(item)) for msg_id, item in chunk]
+            )
+        return []
+
+
+class FileSink(BufferedSink):
+    """ For local runs, Appends json lines """
+
+    chunk_size = 500
+
+    def __init__(self, path):
+        super(FileSink, self).__init__()
+        self.path = path
+
+    def _write(self, chunk):
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(dict(item, msg_id=msg_id)) + "\n" for msg_id, item in chunk)
+        return []
+
+
+SINKS = {
+    "dynamodb": DynamoDbSink,
+    "sqlite": SqliteSink,
+    "file": FileSink,
+}
+
+
+def from_env(spec=GlobalArgs.RESULT_SINK):
+    """ The sink for `RESULT_SINK`, `None` when not configured """
+    if not spec:
+        return None
+    kind, _, target = spec.partition(":")
+    return SINKS[kind](target)
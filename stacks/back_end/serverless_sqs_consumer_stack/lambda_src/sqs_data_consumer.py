@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import json
 import logging
 import os
-import time
-import random
 import boto3
 from botocore.exceptions import ClientError
 
+# Shared through the `pipeline_utils` lambda layer
+from fault_injection import FaultInjector
+from msg_envelope import is_envelope, pack, to_record, unpack
+from msg_routing import WeightedLaneScheduler
+from msg_ttl import is_expired
+
+import result_sinks
+
 
 """
 .. module: sqs_data_consumer
@@ -30,6 +37,18 @@ class GlobalArgs:
     MODULE_NAME = "sqs_data_consumer"
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
     RELIABLE_QUEUE_NAME = os.getenv("RELIABLE_QUEUE_NAME")
+    LANE_QUEUE_NAMES = json.loads(os.getenv("LANE_QUEUE_NAMES", "{}"))
+    LANE_WEIGHTS = json.loads(os.getenv("LANE_WEIGHTS", "{}"))
+    POLL_BATCH_SIZE = int(os.getenv("POLL_BATCH_SIZE", 5))
+    IDLE_WAIT_SECS = int(os.getenv("IDLE_WAIT_SECS", 2))
+    MIN_REMAINING_TIME_MS = int(os.getenv("MIN_REMAINING_TIME_MS", 3000))
+    EXPIRED_QUEUE_NAME = os.getenv("EXPIRED_QUEUE_NAME")
+    DEFAULT_MSG_TTL_SECS = int(os.getenv("DEFAULT_MSG_TTL_SECS", 0))
+    DEAD_LETTER_QUEUE_NAME = os.getenv("DEAD_LETTER_QUEUE_NAME")
+    RETRY_QUEUE_NAME = os.getenv("RETRY_QUEUE_NAME")
+    # `SendMessageBatch` takes at most 10 messages & 256KB in total
+    SQS_BATCH_SIZE = 10
+    SQS_MAX_BATCH_BYTES = 256 * 1024
 
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL):
@@ -42,21 +61,49 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL):
 
 LOG = set_logging()
 sqs_client = boto3.client("sqs")
+FAULTS = FaultInjector.from_env("consume")
+# Buffers the results of a batch, Written in bulk before the batch is acknowledged
+SINK = result_sinks.from_env()
+
+
+class MessageProcessingError(Exception):
+    """ Base for all message failures, `reason` is stamped on dead-lettered messages as `error_reason` """
+    reason = "processing_error"
+
+    def __init__(self, msg=None):
+        if msg is None:
+            msg = f'{{"{self.reason}":{True}}}'
+        super(MessageProcessingError, self).__init__(msg)
+
+
+class TransientError(MessageProcessingError):
+    """ Might succeed later, Retried through the backoff ladder """
+    reason = "transient_error"
+
+
+class PermanentError(MessageProcessingError):
+    """ Fails on every attempt, Sent straight to the dead-letter queue """
+    reason = "permanent_error"
+
+
+class MissingStoreIdError(PermanentError):
+    reason = "missing_store_id"
+
 
+class MalformedBodyError(PermanentError):
+    reason = "malformed_body"
 
-def _rand_coin_flip():
-    r = False
-    if os.getenv("TRIGGER_RANDOM_DELAY", True):
-        if random.randint(1, 100) > 90:
-            r = True
-    return r
 
+# Queue urls never change, Kept outside the handler so each queue is resolved once per cold start
+Q_URLS = {}
 
-def get_q_url(sqs_client):
-    q = sqs_client.get_queue_url(
-        QueueName=GlobalArgs.RELIABLE_QUEUE_NAME).get("QueueUrl")
-    LOG.debug(f'{{"q_url":"{q}"}}')
-    return q
+
+def get_q_url(sqs_client, q_name=GlobalArgs.RELIABLE_QUEUE_NAME):
+    if q_name not in Q_URLS:
+        Q_URLS[q_name] = sqs_client.get_queue_url(
+            QueueName=q_name).get("QueueUrl")
+        LOG.debug(f'{{"q_url":"{Q_URLS[q_name]}"}}')
+    return Q_URLS[q_name]
 
 
 def get_msgs(q_url, max_msgs, wait_time):
@@ -75,21 +122,183 @@ def get_msgs(q_url, max_msgs, wait_time):
         return msg_batch
 
 
+def _to_msg_attrs(m_attr):
+    """ Event record attributes(`stringValue`) back to the `send_message` shape(`StringValue`) """
+    return {
+        k: {"DataType": v["dataType"], "StringValue": v["stringValue"]}
+        for k, v in m_attr.items() if v.get("stringValue") is not None
+    }
+
+
+def _entry_bytes(entry):
+    """ Size of a `send_message_batch` entry, as SQS counts it: the body, & the name, type & value of each attribute """
+    return len(entry["MessageBody"].encode("utf-8")) + sum(
+        len(k.encode("utf-8")) + len(v["DataType"].encode("utf-8")) + len(v["StringValue"].encode("utf-8"))
+        for k, v in entry["MessageAttributes"].items()
+    )
+
+
+def _batch_entries(entries):
+    """ Split the entries into batches that `send_message_batch` accepts, Envelopes can fill a batch on their own """
+    batch, batch_bytes = [], 0
+    for entry in entries:
+        entry_bytes = _entry_bytes(entry)
+        if batch and (len(batch) == GlobalArgs.SQS_BATCH_SIZE or
+                      batch_bytes + entry_bytes > GlobalArgs.SQS_MAX_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
+
+def send_msgs(q_url, msg_batch):
+    """ Forward records as-is to another queue, in batches within the limits of `send_message_batch` """
+    entries = [
+        {
+            "MessageBody": m["body"],
+            "MessageAttributes": _to_msg_attrs(m.get("messageAttributes", {}))
+        } for m in msg_batch
+    ]
+    for batch in _batch_entries(entries):
+        resp = sqs_client.send_message_batch(
+            QueueUrl=q_url,
+            Entries=[dict(e, Id=str(j)) for j, e in enumerate(batch)]
+        )
+        if resp.get("Failed"):
+            raise Exception(
+                f'{{"send_msgs_failed":{json.dumps(resp["Failed"])}}}')
+
+
+def forward_msgs(q_url, msg_batch):
+    """ Like `send_msgs`, but records unpacked from an envelope are packed again into new envelopes """
+    plain, by_envelope = [], {}
+    for m in msg_batch:
+        if "envelopeId" in m:
+            by_envelope.setdefault(m["envelopeId"], []).append(m)
+        else:
+            plain.append(m)
+    for env_records in by_envelope.values():
+        # Retain the envelope attributes like `shard` & `sqs-dlq-replay-cnt`
+        env_attrs = env_records[0]["envelopeAttributes"]
+        for body, record_cnt in pack([to_record(m) for m in env_records]):
+            plain.append({
+                "body": body,
+                "messageAttributes": dict(env_attrs, record_cnt={
+                    "stringValue": f"{record_cnt}", "dataType": "Number"})
+            })
+    if plain:
+        send_msgs(q_url, plain)
+
+
+def to_result(m):
+    """ The downstream item for a processed message """
+    m_attr = m.get("messageAttributes", {})
+    return {
+        "store_id": m_attr.get("store_id", {}).get("stringValue"),
+        "priority": m_attr.get("priority", {}).get("stringValue"),
+        "envelope_id": m.get("envelopeId"),
+        "processed_at": int(datetime.datetime.now().timestamp()),
+        "body": m["body"],
+    }
+
+
+def process_msg(m):
+    """ Process a single message, Returns its result, Raises a `MessageProcessingError` on failure """
+    # Injected latency can breach the msg 'visibility Timeout', Injected failures are retried
+    FAULTS.inject("ProcessMessage")
+    # If bad message crash out with exception
+    if "messageAttributes" in m and "store_id" not in m.get("messageAttributes"):
+        raise MissingStoreIdError()
+    try:
+        json.loads(m["body"])
+    except ValueError:
+        raise MalformedBodyError()
+    return to_result(m)
+
+
+def _fail_msg(m, e, poison, failed):
+    """ Tag poison pills with their `error_reason`, Without a dead-letter queue they are retried """
+    LOG.error(f"ERROR:{str(e)}")
+    if not GlobalArgs.DEAD_LETTER_QUEUE_NAME:
+        failed.append(m)
+        return
+    m.setdefault("messageAttributes", {})["error_reason"] = {
+        "stringValue": e.reason, "dataType": "String"}
+    poison.append(m)
+
+
 def process_msgs(msg_batch):
+    """
+    Process a batch of messages, one at a time.
+
+    Envelopes are unpacked & their records processed one at a time as well.
+    Expired messages go to the expired queue & poison pills(`PermanentError`)
+    straight to the dead-letter queue. Any other failure is retried, the ids
+    of those messages are returned in `failed_msg_ids`. Failed records of an
+    envelope are packed into a new envelope for the retry queue instead, so
+    the good records are not processed again.
+
+    Results are written to the `SINK` in bulk once the batch is processed,
+    messages whose results could not be written are retried like any other
+    transient failure.
+    """
     try:
         m_process_stat = {}
-        err = f'{{"missing_store_id":{True}}}'
+        records, poison, failed = [], [], []
         for m in msg_batch:
-            # If bad message crash out with exception
-            if "messageAttributes" in m and "store_id" not in m.get("messageAttributes"):
-                LOG.exception(err)
-                raise Exception(err)
-            # Randomly time out lambda causing, msg 'visibility Timeout' breach
-            # if _rand_coin_flip():
-            #     LOG.info(f'{{"trigger_random_delay":{True}}}')
-            #     time.sleep(30)
+            if not is_envelope(m.get("messageAttributes", {})):
+                records.append(m)
+                continue
+            try:
+                records.extend(unpack(m))
+            except (ValueError, KeyError, TypeError):
+                _fail_msg(m, MalformedBodyError(), poison, failed)
+        # Shed messages past their TTL before spending any effort on them, Only with somewhere to park them
+        now = datetime.datetime.now().timestamp()
+        fresh, expired = records, []
+        if GlobalArgs.EXPIRED_QUEUE_NAME:
+            fresh = []
+            for m in records:
+                (expired if is_expired(m, now, GlobalArgs.DEFAULT_MSG_TTL_SECS) else fresh).append(m)
+        processed, ok = {}, []
+        for m in fresh:
+            try:
+                result = process_msg(m)
+                ok.append(m)
+                if SINK:
+                    processed[m["messageId"]] = m
+                    SINK.put(m["messageId"], result)
+            except PermanentError as e:
+                _fail_msg(m, e, poison, failed)
+            except Exception as e:
+                # Unclassified failures might succeed on a retry
+                LOG.exception(f"ERROR:{str(e)}")
+                failed.append(m)
+        sink_failed_ids = SINK.flush() if SINK else []
+        failed.extend(processed[m_id] for m_id in sink_failed_ids)
+        if expired:
+            forward_msgs(get_q_url(
+                sqs_client, GlobalArgs.EXPIRED_QUEUE_NAME), expired)
+        if poison:
+            forward_msgs(get_q_url(
+                sqs_client, GlobalArgs.DEAD_LETTER_QUEUE_NAME), poison)
+        failed_msg_ids = [m["messageId"] for m in failed if "envelopeId" not in m]
+        repacked = [m for m in failed if "envelopeId" in m]
+        if repacked and GlobalArgs.RETRY_QUEUE_NAME:
+            forward_msgs(get_q_url(
+                sqs_client, GlobalArgs.RETRY_QUEUE_NAME), repacked)
+        else:
+            failed_msg_ids.extend({m["envelopeId"]: None for m in repacked})
+            repacked = []
         m_process_stat = {
-            "s_msgs": len(msg_batch),
+            "s_msgs": len(ok) - len(sink_failed_ids),
+            "expired_msgs": len(expired),
+            "poison_msgs": len(poison),
+            "repacked_msgs": len(repacked),
+            "sink_failed_msgs": len(sink_failed_ids),
+            "failed_msg_ids": failed_msg_ids,
         }
         LOG.debug(f'{{"m_process_stat":"{json.dumps(m_process_stat)}"}}')
     except Exception as e:
@@ -103,14 +312,119 @@ def del_msgs(q_url, m_to_del):
     sqs_client.delete_message_batch(QueueUrl=q_url, Entries=m_to_del)
 
 
+def del_handled_msgs(q_url, msg_batch, failed_msg_ids):
+    """ Delete everything but the failed messages, so only those are received again """
+    m_to_del = [
+        {"Id": str(i), "ReceiptHandle": m["receiptHandle"]}
+        for i, m in enumerate(msg_batch) if m["messageId"] not in failed_msg_ids
+    ]
+    if m_to_del:
+        del_msgs(q_url, m_to_del)
+
+
+def _to_event_records(msg_batch):
+    """ Reshape `receive_message` output like the records of an SQS event, so both paths share `process_msgs` """
+    records = []
+    for m in msg_batch.get("Messages", []):
+        m_attr = {}
+        for k, v in m.get("MessageAttributes", {}).items():
+            m_attr[k] = {"stringValue": v.get(
+                "StringValue"), "dataType": v.get("DataType")}
+        records.append({
+            "messageId": m["MessageId"],
+            "receiptHandle": m["ReceiptHandle"],
+            "body": m["Body"],
+            "attributes": m.get("Attributes", {}),
+            "messageAttributes": m_attr
+        })
+    return records
+
+
+def poll_lanes(context):
+    lane_urls = {
+        l: get_q_url(sqs_client, q) for l, q in GlobalArgs.LANE_QUEUE_NAMES.items()
+    }
+    sched = WeightedLaneScheduler(
+        {l: GlobalArgs.LANE_WEIGHTS.get(l, 1) for l in lane_urls})
+    p_stat = {"polls": 0, "failed_batches": 0, "failed_msgs": 0,
+              "expired_msgs": 0, "poison_msgs": 0, "repacked_msgs": 0,
+              "sink_failed_msgs": 0,
+              "lane_msgs": dict.fromkeys(lane_urls, 0)}
+    # Lanes with a weight of 0 are never polled, Nothing to do when that is all of them
+    if not sched.weights:
+        LOG.warning(f'{{"no_lane_to_poll":{json.dumps(GlobalArgs.LANE_WEIGHTS)}}}')
+        return p_stat
+    top_lane = max(sched.weights, key=sched.weights.get)
+    idle = set()
+    while context.get_remaining_time_in_millis() > GlobalArgs.MIN_REMAINING_TIME_MS:
+        lane = sched.next_lane(skip=idle)
+        wait_time = 0
+        # All lanes are drained, Long poll the top lane before starting a new round
+        if lane is None:
+            idle.clear()
+            lane = top_lane
+            wait_time = GlobalArgs.IDLE_WAIT_SECS
+        msg_batch = _to_event_records(
+            get_msgs(lane_urls[lane], GlobalArgs.POLL_BATCH_SIZE, wait_time))
+        p_stat["polls"] += 1
+        if not msg_batch:
+            idle.add(lane)
+            continue
+        try:
+            m_process_stat = process_msgs(msg_batch)
+        except Exception:
+            # Leave the batch on the lane, It will be redriven after `maxReceiveCount`
+            p_stat["failed_batches"] += 1
+            continue
+        # Failed messages are left on the lane, They will be redriven after `maxReceiveCount`
+        del_handled_msgs(lane_urls[lane], msg_batch,
+                         m_process_stat["failed_msg_ids"])
+        p_stat["lane_msgs"][lane] += len(msg_batch)
+        p_stat["failed_msgs"] += len(m_process_stat["failed_msg_ids"])
+        p_stat["expired_msgs"] += m_process_stat["expired_msgs"]
+        p_stat["poison_msgs"] += m_process_stat["poison_msgs"]
+        p_stat["repacked_msgs"] += m_process_stat["repacked_msgs"]
+        p_stat["sink_failed_msgs"] += m_process_stat["sink_failed_msgs"]
+    LOG.debug(f'{{"p_stat":{json.dumps(p_stat)}}}')
+    return p_stat
+
+
 def lambda_handler(event, context):
     resp = {"status": False}
     LOG.info(f"Event: {json.dumps(event)}")
-    if event["Records"]:
+    FAULTS.reset_stat()
+    resp["faults"] = FAULTS.stat
+    if event.get("Records"):
         resp["tot_msgs"] = len(event["Records"])
         LOG.info(f'{{"tot_msgs":{resp["tot_msgs"]}}}')
         m_process_stat = process_msgs(event["Records"])
         resp["s_msgs"] = m_process_stat.get("s_msgs")
+        resp["expired_msgs"] = m_process_stat.get("expired_msgs")
+        resp["poison_msgs"] = m_process_stat.get("poison_msgs")
+        resp["repacked_msgs"] = m_process_stat.get("repacked_msgs")
+        resp["sink_failed_msgs"] = m_process_stat.get("sink_failed_msgs")
+        failed_msg_ids = m_process_stat.get("failed_msg_ids")
+        if failed_msg_ids:
+            # Fail the invocation for the retryable messages only
+            src_q_name = event["Records"][0]["eventSourceARN"].split(":")[-1]
+            del_handled_msgs(get_q_url(sqs_client, src_q_name),
+                             event["Records"], failed_msg_ids)
+            LOG.info(f'{{"resp":{json.dumps(resp)}}}')
+            raise TransientError(
+                f'{{"failed_msg_ids":{json.dumps(failed_msg_ids)}}}')
+        resp["status"] = True
+        LOG.info(f'{{"resp":{json.dumps(resp)}}}')
+    # Scheduled invocation, Poll the priority lanes until we run out of time
+    elif GlobalArgs.LANE_QUEUE_NAMES:
+        p_stat = poll_lanes(context)
+        resp["tot_msgs"] = sum(p_stat["lane_msgs"].values())
+        resp["lane_msgs"] = p_stat["lane_msgs"]
+        resp["failed_batches"] = p_stat["failed_batches"]
+        resp["failed_msgs"] = p_stat["failed_msgs"]
+        resp["expired_msgs"] = p_stat["expired_msgs"]
+        resp["poison_msgs"] = p_stat["poison_msgs"]
+        resp["repacked_msgs"] = p_stat["repacked_msgs"]
+        resp["sink_failed_msgs"] = p_stat["sink_failed_msgs"]
         resp["status"] = True
         LOG.info(f'{{"resp":{json.dumps(resp)}}}')
 
@@ -1,3 +1,7 @@
+import json
+
+from aws_cdk import aws_events as _evnts
+from aws_cdk import aws_events_targets as _evnts_tgt
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk import aws_logs as _logs
@@ -26,42 +30,101 @@ class ServerlessSqsConsumerStack(core.Stack):
         construct_id: str,
         stack_log_level: str,
         max_msg_receive_cnt: int,
-        reliable_queue,
+        priority_lanes: dict,
+        lane_weights: dict,
+        retry_queue,
+        dead_letter_queue,
+        expired_queue,
+        default_msg_ttl_secs: int,
+        results_table,
+        pipeline_utils_layer,
+        fault_injection_profile: dict,
+        queue_topology: dict,
         **kwargs
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         # Add your stack resources below)
 
-        # Read Lambda Code
-        try:
-            with open("stacks/back_end/serverless_sqs_consumer_stack/lambda_src/sqs_data_consumer.py",
-                      encoding="utf-8",
-                      mode="r"
-                      ) as f:
-                msg_consumer_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
+        # Latency sensitive lanes are consumed by an SQS event source, the rest by the scheduled lane poller
+        event_source_lanes = {
+            l: q for l, q in priority_lanes.items() if l in queue_topology["event_source_lanes"]
+        }
+        polled_lanes = {
+            l: q for l, q in priority_lanes.items() if l not in event_source_lanes
+        }
+
+        consumer_fn_env = {
+            "LOG_LEVEL": f"{stack_log_level}",
+            "APP_ENV": "Production",
+            "RELIABLE_QUEUE_NAME": f"{priority_lanes['normal'].queue_name}",
+            "EXPIRED_QUEUE_NAME": f"{expired_queue.queue_name}",
+            "DEAD_LETTER_QUEUE_NAME": f"{dead_letter_queue.queue_name}",
+            "RETRY_QUEUE_NAME": f"{retry_queue.queue_name}",
+            "DEFAULT_MSG_TTL_SECS": f"{default_msg_ttl_secs}",
+            "RESULT_SINK": f"dynamodb:{results_table.table_name}",
+            "FAULT_INJECTION_PROFILE": json.dumps(fault_injection_profile)
+        }
+
+        # Lambda Code is packaged from its source directory, as it outgrew the inline code size limit(4KB)
         msg_consumer_fn = _lambda.Function(
             self,
             "msgConsumerFn",
             function_name=f"queue_consumer_fn_{construct_id}",
             description="Process messages in SQS queue",
             runtime=_lambda.Runtime.PYTHON_3_7,
-            code=_lambda.InlineCode(
-                msg_consumer_fn_code),
-            handler="index.lambda_handler",
-            timeout=core.Duration.seconds(3),
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_sqs_consumer_stack/lambda_src"),
+            handler="sqs_data_consumer.lambda_handler",
+            timeout=core.Duration.seconds(
+                queue_topology["consumer_timeout_secs"]),
             reserved_concurrent_executions=1,
-            environment={
-                "LOG_LEVEL": f"{stack_log_level}",
-                "APP_ENV": "Production",
-                "RELIABLE_QUEUE_NAME": f"{reliable_queue.queue_name}",
-                "TRIGGER_RANDOM_DELAY": "True"
-            }
+            environment=dict(
+                consumer_fn_env,
+                LANE_QUEUE_NAMES=json.dumps(
+                    {l: q.queue_name for l, q in polled_lanes.items()}),
+                LANE_WEIGHTS=json.dumps(
+                    {l: w for l, w in lane_weights.items() if l in polled_lanes}),
+                POLL_BATCH_SIZE=f"{queue_topology['consumer_batch_size']}"
+            ),
+            layers=[pipeline_utils_layer]
         )
 
+        consumer_fns = [msg_consumer_fn]
+        msg_event_consumer_fn = None
+        if event_source_lanes:
+            # The scheduled poller is idle for a few secs every minute, Event source lanes are consumed
+            # as soon as a message arrives. SQS requires the function timeout within the visibility timeout.
+            msg_event_consumer_fn = _lambda.Function(
+                self,
+                "msgEventConsumerFn",
+                function_name=f"queue_event_consumer_fn_{construct_id}",
+                description="Process messages in the latency sensitive SQS lanes",
+                runtime=_lambda.Runtime.PYTHON_3_7,
+                code=_lambda.Code.from_asset(
+                    "stacks/back_end/serverless_sqs_consumer_stack/lambda_src"),
+                handler="sqs_data_consumer.lambda_handler",
+                timeout=core.Duration.seconds(
+                    queue_topology["visibility_timeout_secs"]),
+                reserved_concurrent_executions=1,
+                environment=consumer_fn_env,
+                layers=[pipeline_utils_layer]
+            )
+
+            msg_event_consumer_fn_lg = _logs.LogGroup(
+                self,
+                "msgEventConsumerFnLogGroup",
+                log_group_name=f"/aws/lambda/{msg_event_consumer_fn.function_name}",
+                removal_policy=core.RemovalPolicy.DESTROY,
+                retention=_logs.RetentionDays.ONE_DAY
+            )
+
+            # Set our Lambda Function to be invoked by SQS
+            for q in event_source_lanes.values():
+                msg_event_consumer_fn.add_event_source(
+                    _sqsEventSource(q, batch_size=queue_topology["consumer_batch_size"]))
+            consumer_fns.append(msg_event_consumer_fn)
+
         # Create Custom Loggroup for Producer
         msg_consumer_fn_lg = _logs.LogGroup(
             self,
@@ -71,21 +134,38 @@ class ServerlessSqsConsumerStack(core.Stack):
             retention=_logs.RetentionDays.ONE_DAY
         )
 
-        # # Grant our Lambda Consumer privileges to READ from SQS
-        # reliable_queue.grant_consume_messages(msg_consumer_fn)
+        # Grant our Lambda Consumer privileges to READ from all the priority lanes
+        for q in polled_lanes.values():
+            q.grant_consume_messages(msg_consumer_fn)
+
+        for fn in consumer_fns:
+            # Grant our Lambda Consumers privileges to park expired messages & poison pills
+            expired_queue.grant_send_messages(fn)
+            dead_letter_queue.grant_send_messages(fn)
+
+            # Grant our Lambda Consumers privileges to retry the failed records of an envelope
+            retry_queue.grant_send_messages(fn)
+
+            # Grant our Lambda Consumers privileges to write the results
+            results_table.grant_write_data(fn)
 
         # Restrict Produce Lambda to be invoked only from the stack owner account
         msg_consumer_fn.add_permission(
             "restrictLambdaInvocationToOwnAccount",
             principal=_iam.AccountRootPrincipal(),
             action="lambda:InvokeFunction",
-            source_account=core.Aws.ACCOUNT_ID,
-            source_arn=reliable_queue.queue_arn
+            source_account=core.Aws.ACCOUNT_ID
         )
 
-        # Set our Lambda Function to be invoked by SQS
-        msg_consumer_fn.add_event_source(
-            _sqsEventSource(reliable_queue, batch_size=5))
+        # SQS event sources poll each queue independently, So our consumer polls the remaining lanes
+        # itself with weighted fair scheduling. Kick off a polling run every minute.
+        lane_poller_rule = _evnts.Rule(
+            self,
+            "lanePollerRule",
+            schedule=_evnts.Schedule.rate(core.Duration.minutes(
+                queue_topology["consumer_schedule_mins"])),
+            targets=[_evnts_tgt.LambdaFunction(msg_consumer_fn)]
+        )
 
         ###########################################
         ################# OUTPUTS #################
@@ -103,3 +183,11 @@ class ServerlessSqsConsumerStack(core.Stack):
             value=f"https://console.aws.amazon.com/lambda/home?region={core.Aws.REGION}#/functions/{msg_consumer_fn.function_name}",
             description="Process messages in SQS queue"
         )
+
+        if msg_event_consumer_fn:
+            output_3 = core.CfnOutput(
+                self,
+                "msgEventConsumer",
+                value=f"https://console.aws.amazon.com/lambda/home?region={core.Aws.REGION}#/functions/{msg_event_consumer_fn.function_name}",
+                description="Process messages in the latency sensitive SQS lanes"
+            )
@@ -3,13 +3,42 @@ import logging
 import datetime
 import os
 import random
+import time
+import uuid
 import boto3
 from botocore.exceptions import ClientError
 
+# Shared through the `pipeline_utils` lambda layer
+from fault_injection import FaultInjectedError, FaultInjector
+from msg_envelope import EnvelopePacker, envelope_attrs
+from msg_routing import shard_for
+
 
 class GlobalArgs:
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
     RELIABLE_QUEUE_NAME = os.getenv("RELIABLE_QUEUE_NAME")
+    HIGH_PRIORITY_QUEUE_NAME = os.getenv("HIGH_PRIORITY_QUEUE_NAME")
+    SHARD_LANE_QUEUE_NAMES = json.loads(
+        os.getenv("SHARD_LANE_QUEUE_NAMES", "[]"))
+    HIGH_PRIORITY_PCT = int(os.getenv("HIGH_PRIORITY_PCT", 0))
+    HIGH_PRIORITY_MSG_TTL_SECS = int(
+        os.getenv("HIGH_PRIORITY_MSG_TTL_SECS", 0))
+    BACKLOG_QUEUE_NAMES = json.loads(os.getenv("BACKLOG_QUEUE_NAMES", "[]"))
+    BACKLOG_SAMPLE_SECS = float(os.getenv("BACKLOG_SAMPLE_SECS", 1))
+    TARGET_BACKLOG = int(os.getenv("TARGET_BACKLOG", 0))
+    MIN_SEND_RATE = float(os.getenv("MIN_SEND_RATE", 5))
+    MAX_SEND_RATE = float(os.getenv("MAX_SEND_RATE", 200))
+    SEND_RATE_INCR_STEP = float(os.getenv("SEND_RATE_INCR_STEP", 20))
+    SEND_RATE_DECR_FACTOR = float(os.getenv("SEND_RATE_DECR_FACTOR", 0.5))
+    PACK_RECORDS = os.getenv("PACK_RECORDS", "False").lower() == "true"
+    MAX_ENVELOPE_BYTES = int(os.getenv("MAX_ENVELOPE_BYTES", 250 * 1024))
+    MAX_ENVELOPE_WAIT_MS = int(os.getenv("MAX_ENVELOPE_WAIT_MS", 500))
+    MIN_REMAINING_TIME_MS = int(os.getenv("MIN_REMAINING_TIME_MS", 100))
+    SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+    SEND_BACKOFF_BASE_MS = int(os.getenv("SEND_BACKOFF_BASE_MS", 50))
+    SEND_BACKOFF_CAP_MS = int(os.getenv("SEND_BACKOFF_CAP_MS", 1000))
+    # Distinct `store_id`s, the partition keys of the shards
+    STORE_CNT = int(os.getenv("STORE_CNT", 4))
 
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL):
@@ -19,62 +48,250 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL):
     return logger
 
 
-def _rand_coin_flip():
-    r = False
-    if os.getenv("TRIGGER_RANDOM_FAILURES", True):
-        if random.randint(1, 100) > 90:
-            r = True
-    return r
-
-
 def gen_dob(max_age=99, date_fmt="%Y-%m-%d"):
     return (
         datetime.datetime.today() - datetime.timedelta(days=random.randint(0, 365 * max_age))
     ).strftime(date_fmt)
 
 
-def get_q_url(sqs_client):
+def _rand_priority():
+    p = "normal"
+    if random.randint(1, 100) <= GlobalArgs.HIGH_PRIORITY_PCT:
+        p = "high"
+    return p
+
+
+def get_q_url(sqs_client, q_name=GlobalArgs.RELIABLE_QUEUE_NAME):
     q = sqs_client.get_queue_url(
-        QueueName=GlobalArgs.RELIABLE_QUEUE_NAME).get("QueueUrl")
+        QueueName=q_name).get("QueueUrl")
     LOG.debug(f'{{"q_url":"{q}"}}')
     return q
 
 
+def get_shard_lane_urls(sqs_client):
+    """ For every shard, Map each priority lane the producer writes to, to its queue url """
+    shard_lanes = GlobalArgs.SHARD_LANE_QUEUE_NAMES or [{
+        "normal": GlobalArgs.RELIABLE_QUEUE_NAME,
+        "high": GlobalArgs.HIGH_PRIORITY_QUEUE_NAME
+    }]
+    return [
+        {l: get_q_url(sqs_client, q) for l, q in lanes.items() if q}
+        for lanes in shard_lanes
+    ]
+
+
+# Error codes of throttled SQS calls, Including the one raised by the fault injector
+THROTTLING_ERRORS = ("ThrottlingException", "RequestThrottled")
+
+
+def _send_backoff(n):
+    cap = min(GlobalArgs.SEND_BACKOFF_CAP_MS,
+              GlobalArgs.SEND_BACKOFF_BASE_MS * 2 ** n)
+    time.sleep(random.uniform(0, cap) / 1000)
+
+
 def send_msg(sqs_client, q_url, msg_body, msg_attr=None):
+    """ Throttled sends are retried with full jitter backoff, up to `SEND_MAX_RETRIES` times """
     if not msg_attr:
         msg_attr = {}
+    LOG.debug(
+        f'{{"msg_body":{msg_body}, "msg_attr": {json.dumps(msg_attr)}}}')
+    for n in range(GlobalArgs.SEND_MAX_RETRIES + 1):
+        try:
+            FAULTS.inject("SendMessage")
+            return sqs_client.send_message(
+                QueueUrl=q_url,
+                MessageBody=msg_body,
+                MessageAttributes=msg_attr
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in THROTTLING_ERRORS or n == GlobalArgs.SEND_MAX_RETRIES:
+                LOG.error(f"ERROR:{str(e)}")
+                raise e
+            LOG.warning(f'{{"send_throttled":{n + 1}}}')
+            _send_backoff(n)
+
+
+class AimdRateController:
+    """
+    Additive Increase/Multiplicative Decrease of the send rate(msgs/sec).
+
+    The rate grows by `incr_step` for every backlog sample at or below the
+    target and is cut by `decr_factor` when the consumers fall behind.
+    """
+
+    def __init__(self, target_backlog, min_rate, max_rate, incr_step, decr_factor):
+        self.target_backlog = target_backlog
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.incr_step = incr_step
+        self.decr_factor = decr_factor
+        self.rate = min_rate
+        self._next_send_at = 0.0
+
+    def update(self, backlog):
+        if backlog > self.target_backlog:
+            self.rate = max(self.min_rate, self.rate * self.decr_factor)
+        else:
+            self.rate = min(self.max_rate, self.rate + self.incr_step)
+        return self.rate
+
+    def wait(self, max_wait):
+        """ Block until the next send slot, but never longer than `max_wait` seconds """
+        now = time.monotonic()
+        self._next_send_at = max(self._next_send_at, now)
+        delay = min(self._next_send_at - now, max_wait)
+        if delay > 0:
+            time.sleep(delay)
+        self._next_send_at += 1 / self.rate
+
+
+class BacklogSampler:
+    """
+    Estimate the backlog(visible + in flight) across queues.
+
+    Delayed messages are left out, they are not consumable yet & a lane with
+    a delivery delay would always hold `rate x delay` of them, capping the
+    send rate well below what the consumers can take.
+
+    To bound the polling cost, At most one `GetQueueAttributes` call is made
+    every `sample_secs`, rotating across the queues. The other queues count
+    with their last known depth.
+    """
+
+    BACKLOG_ATTRS = [
+        "ApproximateNumberOfMessages",
+        "ApproximateNumberOfMessagesNotVisible"
+    ]
+
+    def __init__(self, sqs_client, q_urls, sample_secs):
+        self.sqs_client = sqs_client
+        self.q_urls = list(q_urls)
+        self.sample_secs = sample_secs
+        self.backlog = None
+        self._q_backlog = {}
+        self._i = 0
+        self._last_sample_at = None
+
+    def _sample_q(self, q_url):
+        attrs = self.sqs_client.get_queue_attributes(
+            QueueUrl=q_url, AttributeNames=self.BACKLOG_ATTRS).get("Attributes", {})
+        self._q_backlog[q_url] = sum(
+            int(attrs.get(a, 0)) for a in self.BACKLOG_ATTRS)
+
+    def sample(self):
+        """ Returns a fresh backlog estimate, or `None` if no sample is due """
+        now = time.monotonic()
+        if self._last_sample_at is not None and now - self._last_sample_at < self.sample_secs:
+            return None
+        # Prime with all the queues on the first sample
+        if self._last_sample_at is None:
+            for q_url in self.q_urls:
+                self._sample_q(q_url)
+        else:
+            self._sample_q(self.q_urls[self._i % len(self.q_urls)])
+            self._i += 1
+        self._last_sample_at = now
+        self.backlog = sum(self._q_backlog.values())
+        LOG.debug(f'{{"backlog":{self.backlog}}}')
+        return self.backlog
+
+
+def send_packed(sqs_client, q_url, body, record_cnt, msg_attr):
+    """ Send a closed envelope, Returns the count of records that could not be sent """
     try:
-        LOG.debug(
-            f'{{"msg_body":{msg_body}, "msg_attr": {json.dumps(msg_attr)}}}')
-        resp = sqs_client.send_message(
-            QueueUrl=q_url,
-            MessageBody=msg_body,
-            MessageAttributes=msg_attr
-        )
-    except ClientError as e:
-        LOG.error(f"ERROR:{str(e)}")
-        raise e
-    else:
-        return resp
+        send_msg(sqs_client, q_url, body, envelope_attrs(record_cnt, msg_attr))
+    except (FaultInjectedError, ClientError):
+        return record_cnt
+    PACKED["envelopes"] += 1
+    PACKED["records"] += record_cnt
+    return 0
+
+
+def send_envelope(sqs_client, q_url, packer, msg_attr):
+    """ Close the open envelope of the packer & send it, Returns the count of records that could not be sent """
+    record_cnt = len(packer)
+    body = packer.flush()
+    if body:
+        return send_packed(sqs_client, q_url, body, record_cnt, msg_attr)
+    return 0
+
+
+def records_per_msg():
+    """ Records in an SQS message, on average across the envelopes sent so far """
+    if not GlobalArgs.PACK_RECORDS or not PACKED["envelopes"]:
+        return 1
+    return PACKED["records"] / PACKED["envelopes"]
+
+
+def _envelope_msg_attr(shard, priority):
+    return {
+        "shard": {"DataType": "Number", "StringValue": f"{shard}"},
+        "priority": {"DataType": "String", "StringValue": priority}
+    }
 
 
 LOG = set_logging()
 sqs_client = boto3.client("sqs")
+FAULTS = FaultInjector.from_env("produce")
+
+# Kept outside the handler, so warm invocations resume at the last known rate
+RATE_CTRL = AimdRateController(
+    target_backlog=GlobalArgs.TARGET_BACKLOG,
+    min_rate=GlobalArgs.MIN_SEND_RATE,
+    max_rate=GlobalArgs.MAX_SEND_RATE,
+    incr_step=GlobalArgs.SEND_RATE_INCR_STEP,
+    decr_factor=GlobalArgs.SEND_RATE_DECR_FACTOR
+)
+
+# The lanes of every shard, Resolved once per cold start, GetQueueUrl calls grow with the shard count
+SHARD_LANE_URLS = get_shard_lane_urls(sqs_client)
+
+# Envelopes & their records sent since the cold start
+PACKED = {"envelopes": 0, "records": 0}
+
+# Rate control is enabled only with a target backlog & queues to sample
+# Kept outside the handler too, so only cold starts sample every queue
+SAMPLER = None
+if GlobalArgs.TARGET_BACKLOG > 0 and GlobalArgs.BACKLOG_QUEUE_NAMES:
+    SAMPLER = BacklogSampler(
+        sqs_client,
+        [get_q_url(sqs_client, q) for q in GlobalArgs.BACKLOG_QUEUE_NAMES],
+        GlobalArgs.BACKLOG_SAMPLE_SECS
+    )
 
 
 def lambda_handler(event, context):
     resp = {"status": False}
     LOG.debug(f"Event: {json.dumps(event)}")
+    FAULTS.reset_stat()
+    resp["faults"] = FAULTS.stat
 
     _random_user_name = ["Aarakocra", "Aasimar", "Beholder", "Bugbear", "Centaur", "Changeling", "Deep Gnome", "Deva", "Lizardfolk", "Loxodon", "Mind Flayer",
                          "Minotaur", "Orc", "Shardmind", "Shifter", "Simic Hybrid", "Tabaxi", "Yuan-Ti"]
 
     try:
-        q_url = get_q_url(sqs_client)
+        shard_lane_urls = SHARD_LANE_URLS
         msg_cnt = 0
         p_cnt = 0
-        while context.get_remaining_time_in_millis() > 100:
+        f_cnt = 0
+        lane_cnt = {"high": 0, "normal": 0}
+        shard_cnt = [0] * len(shard_lane_urls)
+        # Small records are packed into envelopes per shard & lane, to save on SQS requests
+        packers = {}
+        env_cnt = 0
+        while context.get_remaining_time_in_millis() > GlobalArgs.MIN_REMAINING_TIME_MS:
+            if SAMPLER:
+                backlog = SAMPLER.sample()
+                if backlog is not None:
+                    # The rate paces records, but the backlog counts SQS messages, Envelopes hold many records
+                    RATE_CTRL.update(backlog * records_per_msg())
+                RATE_CTRL.wait(
+                    max_wait=(context.get_remaining_time_in_millis() - GlobalArgs.MIN_REMAINING_TIME_MS) / 1000)
+                if context.get_remaining_time_in_millis() <= GlobalArgs.MIN_REMAINING_TIME_MS:
+                    break
             _s = round(random.random() * 100, 2)
+            _priority = _rand_priority()
             msg_body = {
                 "name": random.choice(_random_user_name),
                 "dob": gen_dob(),
@@ -98,28 +315,94 @@ def lambda_handler(event, context):
                 },
                 "store_id": {
                     "DataType": "Number",
-                    "StringValue": f"{random.randrange(1,5)}"
+                    "StringValue": f"{random.randint(1, GlobalArgs.STORE_CNT)}"
+                },
+                "priority": {
+                    "DataType": "String",
+                    "StringValue": _priority
                 }
             }
-            # Randomly remove ssn_no from message
-            if _rand_coin_flip():
+            # Latency sensitive messages are useless after a short while
+            if _priority == "high" and GlobalArgs.HIGH_PRIORITY_MSG_TTL_SECS:
+                msg_attr["ttl_secs"] = {
+                    "DataType": "Number",
+                    "StringValue": f"{GlobalArgs.HIGH_PRIORITY_MSG_TTL_SECS}"
+                }
+            # Randomly remove store_id from message
+            if FAULTS.bad_msg():
                 msg_attr.pop("store_id", None)
                 msg_attr["bad_msg"] = {
                     "DataType": "String",
                     "StringValue": "True"
                 }
                 p_cnt += 1
-            send_msg(
-                sqs_client,
-                q_url,
-                json.dumps(msg_body),
-                msg_attr
-            )
+            # Route to a shard by `store_id`, so each store stays on one shard
+            _p_key = msg_attr.get("store_id", {}).get(
+                "StringValue", msg_body["ssn_no"])
+            _shard = shard_for(_p_key, len(shard_lane_urls))
+            msg_attr["shard"] = {
+                "DataType": "Number",
+                "StringValue": f"{_shard}"
+            }
+            # Route to the priority lane, Shards without a high lane take everything in normal
+            if _priority not in shard_lane_urls[_shard]:
+                _priority = "normal"
+            msg_attr["priority"]["StringValue"] = _priority
+            if GlobalArgs.PACK_RECORDS:
+                _packer = packers.setdefault(
+                    (_shard, _priority), EnvelopePacker(GlobalArgs.MAX_ENVELOPE_BYTES))
+                _cnt = len(_packer)
+                closed = _packer.add({
+                    "id": uuid.uuid4().hex,
+                    "body": json.dumps(msg_body),
+                    "attrs": {k: v["StringValue"] for k, v in msg_attr.items()}
+                })
+                if closed:
+                    f_cnt += send_packed(
+                        sqs_client,
+                        shard_lane_urls[_shard][_priority],
+                        closed,
+                        _cnt,
+                        _envelope_msg_attr(_shard, _priority)
+                    )
+                    env_cnt += 1
+            else:
+                try:
+                    send_msg(
+                        sqs_client,
+                        shard_lane_urls[_shard][_priority],
+                        json.dumps(msg_body),
+                        msg_attr
+                    )
+                except (FaultInjectedError, ClientError):
+                    f_cnt += 1
             msg_cnt += 1
+            lane_cnt[_priority] += 1
+            shard_cnt[_shard] += 1
+            # Do not hold on to records for too long, when the traffic is slow
+            for (_sh, _pr), _pk in packers.items():
+                if _pk.age_secs() * 1000 > GlobalArgs.MAX_ENVELOPE_WAIT_MS:
+                    f_cnt += send_envelope(
+                        sqs_client, shard_lane_urls[_sh][_pr], _pk, _envelope_msg_attr(_sh, _pr))
+                    env_cnt += 1
             LOG.debug(
                 f'{{"remaining_time":{context.get_remaining_time_in_millis()}}}')
+        for (_sh, _pr), _pk in packers.items():
+            if len(_pk):
+                f_cnt += send_envelope(
+                    sqs_client, shard_lane_urls[_sh][_pr], _pk, _envelope_msg_attr(_sh, _pr))
+                env_cnt += 1
         resp["tot_msgs"] = msg_cnt
         resp["bad_msgs"] = p_cnt
+        resp["failed_sends"] = f_cnt
+        resp["lane_msgs"] = lane_cnt
+        resp["shard_msgs"] = shard_cnt
+        if GlobalArgs.PACK_RECORDS:
+            resp["envelopes"] = env_cnt
+        if SAMPLER:
+            resp["send_rate"] = round(RATE_CTRL.rate, 2)
+            resp["backlog"] = SAMPLER.backlog
+            resp["records_per_msg"] = round(records_per_msg(), 2)
         resp["status"] = True
         LOG.info(f'{{"resp":{json.dumps(resp)}}}')
 
@@ -1,4 +1,7 @@
+import json
+
 from aws_cdk import aws_cloudwatch as _cw
+from aws_cdk import aws_dynamodb as _dynamodb
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk import aws_logs as _logs
@@ -26,95 +29,123 @@ class ServerlessSqsProducerStack(core.Stack):
         scope: core.Construct,
         construct_id: str,
         stack_log_level: str,
+        fault_injection_profile: dict,
+        queue_topology: dict,
+        shard_cnt: int = 1,
+        store_cnt: int = 100,
+        pack_records: bool = False,
         **kwargs
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         # Add your stack resources below):
 
-        # Maximum number of times, a message can be tried to be process from the queue before deleting
-        self.max_msg_receive_cnt = 5
-        self.max_msg_receive_cnt_at_retry = 3
-
-        # Define Dead Letter Queue
-        self.reliable_q_dlq = _sqs.Queue(
+        # Helpers shared by all our lambdas, like fault injection
+        self.pipeline_utils_layer = _lambda.LayerVersion(
             self,
-            "DeadLetterQueue",
-            delivery_delay=core.Duration.seconds(100),
-            queue_name=f"reliable_q_dlq",
-            retention_period=core.Duration.days(2),
-            visibility_timeout=core.Duration.seconds(10),
-            receive_message_wait_time=core.Duration.seconds(10)
+            "pipelineUtilsLayer",
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/lambda_layers/pipeline_utils"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_7],
+            description="Helpers shared by the producer, consumer & retry lambdas"
         )
 
-        # Define Retry Queue for Reliable Q
-        self.reliable_q_retry_1 = _sqs.Queue(
+        # Delays, timeouts & receive counts of all the queues, Tune them with `tools/topology_sim.py`
+        self.queue_topology = queue_topology
+
+        # Maximum number of times, a message can be tried to be process from the queue before deleting
+        self.max_msg_receive_cnt = queue_topology["max_msg_receive_cnt"]
+        self.max_msg_receive_cnt_at_retry = queue_topology["max_msg_receive_cnt_at_retry"]
+
+        # Messages past their TTL are parked here, instead of being processed or replayed
+        self.reliable_q_expired = _sqs.Queue(
             self,
-            "reliableQueueRetry1",
-            delivery_delay=core.Duration.seconds(10),
-            queue_name=f"reliable_q_retry_1",
-            retention_period=core.Duration.days(2),
-            visibility_timeout=core.Duration.seconds(10),
-            receive_message_wait_time=core.Duration.seconds(10),
-            dead_letter_queue=_sqs.DeadLetterQueue(
-                max_receive_count=self.max_msg_receive_cnt_at_retry,
-                queue=self.reliable_q_dlq
-            )
+            "expiredQueue",
+            queue_name=f"reliable_q_expired",
+            retention_period=core.Duration.seconds(
+                queue_topology["message_retention_secs"])
         )
 
-        # Primary Source Queue
-        self.reliable_q = _sqs.Queue(
+        # Results of the processed messages, Written in bulk by the consumers of all the shards
+        self.results_table = _dynamodb.Table(
             self,
-            "reliableQueue",
-            delivery_delay=core.Duration.seconds(5),
-            queue_name=f"reliable_q",
-            retention_period=core.Duration.days(2),
-            visibility_timeout=core.Duration.seconds(10),
-            receive_message_wait_time=core.Duration.seconds(10),
-            dead_letter_queue=_sqs.DeadLetterQueue(
-                max_receive_count=self.max_msg_receive_cnt,
-                queue=self.reliable_q_retry_1
-            )
+            "resultsTable",
+            partition_key=_dynamodb.Attribute(
+                name="msg_id",
+                type=_dynamodb.AttributeType.STRING
+            ),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=core.RemovalPolicy.DESTROY
         )
 
+        # Each shard has its own priority lanes, retry queue & dead-letter queue
+        self.shards = [
+            self._create_shard_queues(shard) for shard in range(shard_cnt)
+        ]
+
+        # The first shard keeps the original queue names
+        self.reliable_q_dlq = self.shards[0]["dlq"]
+        self.reliable_q_retry_1 = self.shards[0]["retry"]
+        self.priority_lanes = self.shards[0]["lanes"]
+        self.reliable_q = self.priority_lanes["normal"]
+        self.reliable_q_high = self.priority_lanes["high"]
+        self.reliable_q_replay = self.priority_lanes["replay"]
+
         ########################################
         #######                          #######
         #######     SQS Data Producer    #######
         #######                          #######
         ########################################
 
-        # Read Lambda Code
-        try:
-            with open("stacks/back_end/serverless_sqs_producer_stack/lambda_src/sqs_data_producer.py",
-                      encoding="utf-8",
-                      mode="r"
-                      ) as f:
-                data_producer_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
-
+        # Lambda Code is packaged from its source directory, as it outgrew the inline code size limit(4KB)
         data_producer_fn = _lambda.Function(
             self,
             "sqsDataProducerFn",
             function_name=f"data_producer_fn_{construct_id}",
             description="Produce data events and push to SQS",
             runtime=_lambda.Runtime.PYTHON_3_7,
-            code=_lambda.InlineCode(
-                data_producer_fn_code),
-            handler="index.lambda_handler",
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_sqs_producer_stack/lambda_src"),
+            handler="sqs_data_producer.lambda_handler",
             timeout=core.Duration.seconds(5),
             reserved_concurrent_executions=1,
             environment={
                 "LOG_LEVEL": f"{stack_log_level}",
                 "APP_ENV": "Production",
-                "RELIABLE_QUEUE_NAME": f"{self.reliable_q.queue_name}",
-                "TRIGGER_RANDOM_FAILURES": "True"
-            }
+                "SHARD_LANE_QUEUE_NAMES": json.dumps([
+                    {l: sq["lanes"][l].queue_name for l in ["high", "normal"]}
+                    for sq in self.shards
+                ]),
+                "HIGH_PRIORITY_PCT": f"{queue_topology['high_priority_pct']}",
+                "HIGH_PRIORITY_MSG_TTL_SECS": f"{queue_topology['high_priority_msg_ttl_secs']}",
+                "BACKLOG_QUEUE_NAMES": json.dumps([
+                    q.queue_name for sq in self.shards for q in sq["lanes"].values()
+                ]),
+                "BACKLOG_SAMPLE_SECS": "1",
+                # The backlog & the send rate are summed over all the shards, Every shard adds to both
+                "TARGET_BACKLOG": f"{500 * shard_cnt}",
+                "MIN_SEND_RATE": "5",
+                "MAX_SEND_RATE": f"{200 * shard_cnt}",
+                "STORE_CNT": f"{store_cnt}",
+                "SEND_RATE_INCR_STEP": "20",
+                "SEND_RATE_DECR_FACTOR": "0.5",
+                "PACK_RECORDS": f"{pack_records}",
+                "MAX_ENVELOPE_BYTES": f"{250 * 1024}",
+                "MAX_ENVELOPE_WAIT_MS": "500",
+                "MIN_REMAINING_TIME_MS": "500",
+                "FAULT_INJECTION_PROFILE": json.dumps(fault_injection_profile)
+            },
+            layers=[self.pipeline_utils_layer]
         )
 
-        # Grant our Lambda Producer privileges to write to SQS
-        self.reliable_q.grant_send_messages(data_producer_fn)
+        for sq in self.shards:
+            # Grant our Lambda Producer privileges to write to SQS
+            sq["lanes"]["normal"].grant_send_messages(data_producer_fn)
+            sq["lanes"]["high"].grant_send_messages(data_producer_fn)
+
+            # Grant our Lambda Producer privileges to sample the backlog of the lanes
+            for q in sq["lanes"].values():
+                q.grant(data_producer_fn, "sqs:GetQueueAttributes")
 
         # Create Custom Loggroup for Producer
         data_producer_lg = _logs.LogGroup(
@@ -133,18 +164,6 @@ class ServerlessSqsProducerStack(core.Stack):
             source_account=core.Aws.ACCOUNT_ID
         )
 
-        # Monitoring for Queue
-        reliable_q_alarm = _cw.Alarm(
-            self, "reliableQueueAlarm",
-            metric=self.reliable_q.metric(
-                "ApproximateNumberOfMessagesVisible"),
-            statistic="sum",
-            threshold=10,
-            period=core.Duration.minutes(5),
-            evaluation_periods=1,
-            comparison_operator=_cw.ComparisonOperator.GREATER_THAN_THRESHOLD
-        )
-
         ###########################################
         ################# OUTPUTS #################
         ###########################################
@@ -169,6 +188,144 @@ class ServerlessSqsProducerStack(core.Stack):
             description="Reliable Queue"
         )
 
+    def _create_shard_queues(self, shard):
+        # Shards after the first one get a suffix, So adding shards never replaces the existing queues
+        id_sfx = f"Shard{shard}" if shard else ""
+        name_sfx = f"_shard_{shard}" if shard else ""
+        topo = self.queue_topology
+        delays = topo["delivery_delay_secs"]
+
+        # Define Dead Letter Queue
+        dlq = _sqs.Queue(
+            self,
+            f"DeadLetterQueue{id_sfx}",
+            delivery_delay=core.Duration.seconds(delays["dlq"]),
+            queue_name=f"reliable_q_dlq{name_sfx}",
+            retention_period=core.Duration.seconds(
+                topo["message_retention_secs"]),
+            visibility_timeout=core.Duration.seconds(
+                topo["visibility_timeout_secs"]),
+            receive_message_wait_time=core.Duration.seconds(
+                topo["receive_message_wait_secs"])
+        )
+
+        # Define Retry Queue for Reliable Q
+        retry_q = _sqs.Queue(
+            self,
+            f"reliableQueueRetry1{id_sfx}",
+            delivery_delay=core.Duration.seconds(delays["retry"]),
+            queue_name=f"reliable_q_retry_1{name_sfx}",
+            retention_period=core.Duration.seconds(
+                topo["message_retention_secs"]),
+            visibility_timeout=core.Duration.seconds(
+                topo["visibility_timeout_secs"]),
+            receive_message_wait_time=core.Duration.seconds(
+                topo["receive_message_wait_secs"]),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=self.max_msg_receive_cnt_at_retry,
+                queue=dlq
+            )
+        )
+
+        # Primary Source Queue, Also the `normal` priority lane
+        reliable_q = _sqs.Queue(
+            self,
+            f"reliableQueue{id_sfx}",
+            delivery_delay=core.Duration.seconds(delays["normal"]),
+            queue_name=f"reliable_q{name_sfx}",
+            retention_period=core.Duration.seconds(
+                topo["message_retention_secs"]),
+            visibility_timeout=core.Duration.seconds(
+                topo["visibility_timeout_secs"]),
+            receive_message_wait_time=core.Duration.seconds(
+                topo["receive_message_wait_secs"]),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=self.max_msg_receive_cnt,
+                queue=retry_q
+            )
+        )
+
+        # Latency sensitive traffic gets its own lane, No delivery delay
+        reliable_q_high = _sqs.Queue(
+            self,
+            f"reliableQueueHigh{id_sfx}",
+            delivery_delay=core.Duration.seconds(delays["high"]),
+            queue_name=f"reliable_q_high{name_sfx}",
+            retention_period=core.Duration.seconds(
+                topo["message_retention_secs"]),
+            visibility_timeout=core.Duration.seconds(
+                topo["visibility_timeout_secs"]),
+            receive_message_wait_time=core.Duration.seconds(
+                topo["receive_message_wait_secs"]),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=self.max_msg_receive_cnt,
+                queue=retry_q
+            )
+        )
+
+        # Replayed messages from the retry queue are kept away from fresh traffic
+        reliable_q_replay = _sqs.Queue(
+            self,
+            f"reliableQueueReplay{id_sfx}",
+            delivery_delay=core.Duration.seconds(delays["replay"]),
+            queue_name=f"reliable_q_replay{name_sfx}",
+            retention_period=core.Duration.seconds(
+                topo["message_retention_secs"]),
+            visibility_timeout=core.Duration.seconds(
+                topo["visibility_timeout_secs"]),
+            receive_message_wait_time=core.Duration.seconds(
+                topo["receive_message_wait_secs"]),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=self.max_msg_receive_cnt,
+                queue=retry_q
+            )
+        )
+
+        # Monitoring for Queue
+        reliable_q_alarm = _cw.Alarm(
+            self, f"reliableQueueAlarm{id_sfx}",
+            metric=reliable_q.metric(
+                "ApproximateNumberOfMessagesVisible"),
+            statistic="sum",
+            threshold=10,
+            period=core.Duration.minutes(5),
+            evaluation_periods=1,
+            comparison_operator=_cw.ComparisonOperator.GREATER_THAN_THRESHOLD
+        )
+
+        # Messages are lost after the retention period(2 days), Alarm when the oldest message crosses a day
+        reliable_q_age_alarm = _cw.Alarm(
+            self, f"reliableQueueAgeAlarm{id_sfx}",
+            metric=reliable_q.metric_approximate_age_of_oldest_message(),
+            statistic="max",
+            threshold=core.Duration.days(1).to_seconds(),
+            period=core.Duration.minutes(5),
+            evaluation_periods=1,
+            comparison_operator=_cw.ComparisonOperator.GREATER_THAN_THRESHOLD
+        )
+
+        # High priority lane latency SLO, Oldest message should not wait for more than a minute
+        reliable_q_high_slo_alarm = _cw.Alarm(
+            self, f"reliableQueueHighSloAlarm{id_sfx}",
+            metric=reliable_q_high.metric_approximate_age_of_oldest_message(),
+            statistic="max",
+            threshold=60,
+            period=core.Duration.minutes(1),
+            evaluation_periods=3,
+            comparison_operator=_cw.ComparisonOperator.GREATER_THAN_THRESHOLD
+        )
+
+        # Priority lanes, Producers write to `high` & `normal`, Retries replay to `replay`
+        return {
+            "dlq": dlq,
+            "retry": retry_q,
+            "lanes": {
+                "high": reliable_q_high,
+                "normal": reliable_q,
+                "replay": reliable_q_replay
+            }
+        }
+
     # properties to share with other stacks
     @property
     def get_queue(self):
@@ -177,3 +334,31 @@ class ServerlessSqsProducerStack(core.Stack):
     @property
     def get_dlq(self):
         return self.reliable_q_retry_1
+
+    @property
+    def get_dead_letter_q(self):
+        return self.reliable_q_dlq
+
+    @property
+    def get_replay_q(self):
+        return self.reliable_q_replay
+
+    @property
+    def get_priority_lanes(self):
+        return self.priority_lanes
+
+    @property
+    def get_expired_q(self):
+        return self.reliable_q_expired
+
+    @property
+    def get_results_table(self):
+        return self.results_table
+
+    @property
+    def get_pipeline_utils_layer(self):
+        return self.pipeline_utils_layer
+
+    @property
+    def get_shards(self):
+        return self.shards
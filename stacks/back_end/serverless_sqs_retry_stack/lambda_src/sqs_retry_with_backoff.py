@@ -1,3 +1,4 @@
+import copy
 import datetime
 import json
 import logging
@@ -9,6 +10,11 @@ from urllib.parse import unquote_plus
 import boto3
 from botocore.exceptions import ClientError
 
+# Shared through the `pipeline_utils` lambda layer
+from fault_injection import FaultInjector
+from msg_envelope import is_envelope, pack, to_record, unpack
+from msg_ttl import is_expired
+
 
 class GlobalArgs:
     OWNER = "Mystique"
@@ -19,6 +25,11 @@ class GlobalArgs:
     MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", 3))
     BACKOFF_RATE = int(os.getenv("BACKOFF_RATE", 2))
     MESSAGE_RETENTION_PERIOD = int(os.getenv("MESSAGE_RETENTION_PERIOD"))
+    # SQS rejects a `DelaySeconds` over 15 minutes
+    MAX_DELAY_SECS = 900
+    EXPIRED_QUEUE_NAME = os.getenv("EXPIRED_QUEUE_NAME")
+    DEFAULT_MSG_TTL_SECS = int(os.getenv("DEFAULT_MSG_TTL_SECS", 0))
+    DEAD_LETTER_QUEUE_NAME = os.getenv("DEAD_LETTER_QUEUE_NAME")
 
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL):
@@ -30,13 +41,44 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL):
 
 LOG = set_logging()
 sqs_client = boto3.client("sqs")
+FAULTS = FaultInjector.from_env("replay")
+
+
+# Queue urls never change, Kept outside the handler so each queue is resolved once per cold start
+Q_URLS = {}
+
+
+def get_q_url(sqs_client, q_name=GlobalArgs.RELIABLE_QUEUE_NAME):
+    if q_name not in Q_URLS:
+        Q_URLS[q_name] = sqs_client.get_queue_url(
+            QueueName=q_name).get("QueueUrl")
+        LOG.debug(f'{{"q_url":"{Q_URLS[q_name]}"}}')
+    return Q_URLS[q_name]
 
 
-def get_q_url(sqs_client):
-    q = sqs_client.get_queue_url(
-        QueueName=GlobalArgs.RELIABLE_QUEUE_NAME).get("QueueUrl")
-    LOG.debug(f'{{"q_url":"{q}"}}')
-    return q
+def park_msg(q_name, record):
+    """ Move the message as-is to a sink queue, like the expired queue or the dead-letter queue """
+    attributes = record['messageAttributes']
+    _sqs_attrib_cleaner(attributes)
+    sqs_client.send_message(
+        QueueUrl=get_q_url(sqs_client, q_name),
+        MessageBody=record["body"],
+        MessageAttributes=attributes
+    )
+
+
+def park_records(q_name, record, records):
+    """ Pack some records of the envelope in `record` into new envelopes & send them to a sink queue """
+    for body, record_cnt in pack([to_record(r) for r in records]):
+        attributes = copy.deepcopy(record['messageAttributes'])
+        attributes["record_cnt"] = {
+            "stringValue": f"{record_cnt}", "dataType": "Number"}
+        _sqs_attrib_cleaner(attributes)
+        sqs_client.send_message(
+            QueueUrl=get_q_url(sqs_client, q_name),
+            MessageBody=body,
+            MessageAttributes=attributes
+        )
 
 
 def del_msgs(q_url, m_to_del):
@@ -47,9 +89,44 @@ def del_msgs(q_url, m_to_del):
 def lambda_handler(event, context):
     resp = {"status": False}
     LOG.debug(f"Event: {json.dumps(event)}")
+    FAULTS.reset_stat()
+    resp["faults"] = FAULTS.stat
     q_url = get_q_url(sqs_client)
     resp["tot_msgs"] = len(event["Records"])
+    resp["expired_msgs"] = 0
+    resp["dead_lettered_msgs"] = 0
+    now = datetime.datetime.now().timestamp()
     for record in event["Records"]:
+        # Do not replay messages that nobody needs anymore, Park them in the expired sink
+        if GlobalArgs.EXPIRED_QUEUE_NAME and is_envelope(record['messageAttributes']):
+            fresh, expired = [], []
+            for r in unpack(record):
+                (expired if is_expired(r, now, GlobalArgs.DEFAULT_MSG_TTL_SECS) else fresh).append(r)
+            if expired:
+                park_records(GlobalArgs.EXPIRED_QUEUE_NAME, record, expired)
+                resp["expired_msgs"] += len(expired)
+                if not fresh:
+                    resp["status"] = True
+                    LOG.info(f'{{"resp":{json.dumps(resp)}}}')
+                    continue
+                # Replay only the fresh records, They fit in one envelope as they came from one
+                body, record_cnt = pack([to_record(r) for r in fresh])[0]
+                record["body"] = body
+                record['messageAttributes']["record_cnt"] = {
+                    "stringValue": f"{record_cnt}", "dataType": "Number"}
+        elif GlobalArgs.EXPIRED_QUEUE_NAME and is_expired(record, now, GlobalArgs.DEFAULT_MSG_TTL_SECS):
+            park_msg(GlobalArgs.EXPIRED_QUEUE_NAME, record)
+            resp["expired_msgs"] += 1
+            resp["status"] = True
+            LOG.info(f'{{"resp":{json.dumps(resp)}}}')
+            continue
+        # Messages tagged with an `error_reason` have failed permanently, Replaying them is wasted effort
+        if GlobalArgs.DEAD_LETTER_QUEUE_NAME and "error_reason" in record['messageAttributes']:
+            park_msg(GlobalArgs.DEAD_LETTER_QUEUE_NAME, record)
+            resp["dead_lettered_msgs"] += 1
+            resp["status"] = True
+            LOG.info(f'{{"resp":{json.dumps(resp)}}}')
+            continue
         replay_cnt = 0
         if "sqs-dlq-replay-cnt" in record['messageAttributes']:
             replay_cnt = int(record['messageAttributes']
@@ -57,8 +134,19 @@ def lambda_handler(event, context):
         LOG.info(f'{{"replay_cnt":{replay_cnt}}}')
         replay_cnt += 1
         if replay_cnt > GlobalArgs.MAX_ATTEMPTS:
-            raise MaxAttemptsError(
+            e = MaxAttemptsError(
                 replay=replay_cnt, max=GlobalArgs.MAX_ATTEMPTS)
+            if not GlobalArgs.DEAD_LETTER_QUEUE_NAME:
+                raise e
+            # Dead-letter right away, instead of failing until the retry queue redrives it
+            LOG.error(f"ERROR:{str(e)}")
+            record['messageAttributes']["error_reason"] = {
+                "stringValue": "max_attempts_exceeded", "dataType": "String"}
+            park_msg(GlobalArgs.DEAD_LETTER_QUEUE_NAME, record)
+            resp["dead_lettered_msgs"] += 1
+            resp["status"] = True
+            LOG.info(f'{{"resp":{json.dumps(resp)}}}')
+            continue
         attributes = record['messageAttributes']
         attributes.update(
             {"sqs-dlq-replay-cnt": {'StringValue': str(replay_cnt), 'DataType': 'Number'}})
@@ -70,7 +158,7 @@ def lambda_handler(event, context):
         # Backoff
         b = ExpoBackoffFullJitter(
             base=GlobalArgs.BACKOFF_RATE,
-            cap=GlobalArgs.MESSAGE_RETENTION_PERIOD)
+            cap=min(GlobalArgs.MAX_DELAY_SECS, GlobalArgs.MESSAGE_RETENTION_PERIOD))
         delaySeconds = b.Backoff(n=int(replay_cnt))
 
         resp["replay_cnt"] = replay_cnt
@@ -78,6 +166,7 @@ def lambda_handler(event, context):
         resp["replayed_to_main_q"] = True
         resp["delay_sec"] = delaySeconds
 
+        FAULTS.inject("ReplayMessage")
         sqs_client.send_message(
             QueueUrl=q_url,
             MessageBody=record["body"],
@@ -1,3 +1,5 @@
+import json
+
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_lambda as _lambda
 from aws_cdk import aws_logs as _logs
@@ -29,30 +31,27 @@ class ServerlessSqsRetryStack(core.Stack):
         max_msg_receive_cnt: int,
         reliable_queue,
         reliable_queue_dlq,
+        dead_letter_queue,
+        expired_queue,
+        default_msg_ttl_secs: int,
+        pipeline_utils_layer,
+        fault_injection_profile: dict,
+        queue_topology: dict,
         **kwargs
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         # The code that defines your stack goes here
-        # Read Lambda Code
-        try:
-            with open("stacks/back_end/serverless_sqs_retry_stack/lambda_src/sqs_retry_with_backoff.py",
-                      encoding="utf-8",
-                      mode="r"
-                      ) as f:
-                sqs_retry_fn_code = f.read()
-        except OSError:
-            print("Unable to read Lambda Function Code")
-            raise
+        # Lambda Code is packaged from its source directory, as it outgrew the inline code size limit(4KB)
         sqs_retry_fn = _lambda.Function(
             self,
             "dlqReplayFn",
             function_name=f"sqs_retry_fn_{construct_id}",
             description="Process messages in Retry SQS queue",
             runtime=_lambda.Runtime.PYTHON_3_7,
-            code=_lambda.InlineCode(
-                sqs_retry_fn_code),
-            handler="index.lambda_handler",
+            code=_lambda.Code.from_asset(
+                "stacks/back_end/serverless_sqs_retry_stack/lambda_src"),
+            handler="sqs_retry_with_backoff.lambda_handler",
             timeout=core.Duration.seconds(3),
             reserved_concurrent_executions=1,
             environment={
@@ -60,9 +59,15 @@ class ServerlessSqsRetryStack(core.Stack):
                 "APP_ENV": "Production",
                 "RELIABLE_QUEUE_NAME": f"{reliable_queue.queue_name}",
                 "MAX_RECEIVE_CNT": f"{max_msg_receive_cnt}",
-                "BACKOFF_RATE": "2",
-                "MESSAGE_RETENTION_PERIOD": "172800"
-            }
+                "MAX_ATTEMPTS": f"{queue_topology['max_attempts']}",
+                "BACKOFF_RATE": f"{queue_topology['backoff_rate']}",
+                "MESSAGE_RETENTION_PERIOD": f"{queue_topology['message_retention_secs']}",
+                "EXPIRED_QUEUE_NAME": f"{expired_queue.queue_name}",
+                "DEAD_LETTER_QUEUE_NAME": f"{dead_letter_queue.queue_name}",
+                "DEFAULT_MSG_TTL_SECS": f"{default_msg_ttl_secs}",
+                "FAULT_INJECTION_PROFILE": json.dumps(fault_injection_profile)
+            },
+            layers=[pipeline_utils_layer]
         )
 
         # Create Custom Loggroup for Producer
@@ -85,10 +90,12 @@ class ServerlessSqsRetryStack(core.Stack):
 
         # Set our Lambda Function to be invoked by SQS
         sqs_retry_fn.add_event_source(
-            _sqsEventSource(reliable_queue_dlq, batch_size=1))
+            _sqsEventSource(reliable_queue_dlq, batch_size=queue_topology["retry_batch_size"]))
 
         # Grant our Lambda Producer privileges to write to SQS
         reliable_queue.grant_send_messages(sqs_retry_fn)
+        expired_queue.grant_send_messages(sqs_retry_fn)
+        dead_letter_queue.grant_send_messages(sqs_retry_fn)
 
         ###########################################
         ################# OUTPUTS #################
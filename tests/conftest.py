@@ -0,0 +1,21 @@
+import os
+import sys
+
+
+# The lambdas import their helpers flat, like they are laid out in the lambda runtime
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACK_END_DIR = os.path.join(ROOT_DIR, "stacks", "back_end")
+for d in [
+    "lambda_layers/pipeline_utils/python",
+    "serverless_sqs_consumer_stack/lambda_src",
+    "serverless_sqs_producer_stack/lambda_src",
+    "serverless_sqs_retry_stack/lambda_src",
+]:
+    sys.path.insert(0, os.path.join(BACK_END_DIR, d))
+# And so do the tools
+sys.path.insert(0, os.path.join(ROOT_DIR, "tools"))
+
+# The lambdas create their boto3 clients on import, No calls are made
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+# Set on every retry lambda by its stack
+os.environ.setdefault("MESSAGE_RETENTION_PERIOD", "172800")
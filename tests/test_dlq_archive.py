@@ -0,0 +1,60 @@
+import json
+
+import dlq_archive
+
+
+class FakeSqs:
+    """ A queue whose messages are never deleted, Every receive returns the next `10`, round & round """
+
+    def __init__(self, cnt):
+        self.msgs = [
+            {
+                "MessageId": f"m-{i}",
+                "ReceiptHandle": f"rh-{i}",
+                "Body": json.dumps({"n": i}),
+                "MessageAttributes": {
+                    "ts": {"DataType": "Number", "StringValue": "1600000000"},
+                    "ttl_secs": {"DataType": "Number", "StringValue": "300"},
+                    "shard": {"DataType": "Number", "StringValue": f"{i % 2}"},
+                    "error_reason": {"DataType": "String", "StringValue": "transient_error"},
+                },
+            }
+            for i in range(cnt)
+        ]
+        self._i = 0
+        self.receives = 0
+        self.sent = []
+
+    def get_queue_url(self, QueueName):
+        return {"QueueUrl": QueueName}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, **kw):
+        self.receives += 1
+        batch = [self.msgs[(self._i + j) % len(self.msgs)] for j in range(MaxNumberOfMessages)]
+        self._i += MaxNumberOfMessages - 3
+        return {"Messages": batch}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.sent.extend(Entries)
+        return {"Successful": [{"Id": e["Id"]} for e in Entries]}
+
+
+def test_drain_without_delete_stops_after_one_pass():
+    db, sqs = dlq_archive.open_db(":memory:"), FakeSqs(25)
+    stat = dlq_archive.drain(db, sqs, "reliable_q_dlq", delete=False)
+    assert stat["msgs"] == stat["rows"] == 25
+    assert stat["deleted"] == 0
+    assert sqs.receives < 10
+
+
+def test_reinject_a_shard_with_a_fresh_ts():
+    db, sqs = dlq_archive.open_db(":memory:"), FakeSqs(10)
+    dlq_archive.drain(db, sqs, "reliable_q_dlq", delete=False)
+    rows = dlq_archive.find(db, shard=1)
+    stat = dlq_archive.reinject(db, sqs, "reliable_q_replay_shard_1", rows)
+    assert stat["sent"] == len(rows) == 5
+    attrs = [e["MessageAttributes"] for e in sqs.sent]
+    assert {a["shard"]["StringValue"] for a in attrs} == {"1"}
+    assert all(int(a["ts"]["StringValue"]) > 1600000000 for a in attrs)
+    assert all("error_reason" not in a for a in attrs)
+    assert dlq_archive.find(db, shard=1, pending_only=True) == []
@@ -0,0 +1,112 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import sqs_data_producer
+from fault_injection import FaultInjectedError, FaultInjector
+
+
+PROFILE = {
+    "enabled": True,
+    "seed": 42,
+    "stages": {
+        "consume": {
+            "failure_pct": 30,
+            "throttle_pct": 10,
+            "latency": {"dist": "uniform", "min_ms": 1, "max_ms": 5}
+        }
+    }
+}
+
+
+def _outcomes(injector, cnt=200):
+    out = []
+    for _ in range(cnt):
+        try:
+            injector.inject("ProcessMessage")
+            out.append("ok")
+        except ClientError:
+            out.append("throttle")
+        except FaultInjectedError:
+            out.append("failure")
+    return out
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr("fault_injection.time.sleep", lambda secs: None)
+
+
+def test_a_seed_replays_the_same_faults():
+    a, b = FaultInjector("consume", PROFILE), FaultInjector("consume", PROFILE)
+    assert _outcomes(a) == _outcomes(b)
+    assert a.stat == b.stat
+    assert 0 < a.stat["failures"] < 200 and 0 < a.stat["throttles"] < 200
+
+
+def test_stages_draw_independent_faults():
+    profile = dict(PROFILE, stages={s: PROFILE["stages"]["consume"] for s in ("consume", "replay")})
+    assert _outcomes(FaultInjector("consume", profile)) != _outcomes(FaultInjector("replay", profile))
+
+
+@pytest.mark.parametrize("enabled", [False, "false", "False", 0, None])
+def test_only_a_true_enabled_injects_faults(enabled):
+    injector = FaultInjector("consume", dict(PROFILE, enabled=enabled))
+    assert set(_outcomes(injector)) == {"ok"}
+
+
+def test_enabled_by_default():
+    profile = {k: v for k, v in PROFILE.items() if k != "enabled"}
+    assert "failure" in _outcomes(FaultInjector("consume", profile))
+
+
+def test_reset_stat():
+    injector = FaultInjector("consume", PROFILE)
+    _outcomes(injector)
+    injector.reset_stat()
+    assert injector.stat == {"failures": 0, "throttles": 0, "bad_msgs": 0, "latency_ms": 0}
+
+
+class FakeSqs:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, **kw):
+        self.sent.append(kw)
+        return {"MessageId": f"m-{len(self.sent)}"}
+
+
+@pytest.fixture
+def producer_faults(monkeypatch):
+    monkeypatch.setattr(sqs_data_producer.time, "sleep", lambda secs: None)
+
+    def _set(stage_cfg):
+        faults = FaultInjector("produce", {"seed": 1, "stages": {"produce": stage_cfg}})
+        monkeypatch.setattr(sqs_data_producer, "FAULTS", faults)
+        return faults
+    return _set
+
+
+def test_throttled_sends_are_retried(producer_faults):
+    faults = producer_faults({"throttle_pct": 50})
+    sqs = FakeSqs()
+    for i in range(20):
+        sqs_data_producer.send_msg(sqs, "https://sqs/q", f"{i}")
+    assert len(sqs.sent) == 20
+    assert faults.stat["throttles"] > 0
+
+
+def test_sends_throttled_past_the_retries_fail(producer_faults):
+    faults = producer_faults({"throttle_pct": 100})
+    sqs = FakeSqs()
+    with pytest.raises(ClientError):
+        sqs_data_producer.send_msg(sqs, "https://sqs/q", "body")
+    assert sqs.sent == []
+    assert faults.stat["throttles"] == sqs_data_producer.GlobalArgs.SEND_MAX_RETRIES + 1
+
+
+def test_injected_failures_are_not_retried(producer_faults):
+    faults = producer_faults({"failure_pct": 100})
+    with pytest.raises(FaultInjectedError):
+        sqs_data_producer.send_msg(FakeSqs(), "https://sqs/q", "body")
+    assert faults.stat["failures"] == 1
@@ -0,0 +1,54 @@
+import collections
+import itertools
+
+from msg_routing import WeightedLaneScheduler
+
+
+WEIGHTS = {"high": 6, "normal": 3, "replay": 1}
+
+
+def _turns(sched, n, skip=()):
+    return [sched.next_lane(skip) for _ in range(n)]
+
+
+def test_lanes_are_picked_in_proportion_to_their_weights():
+    picks = collections.Counter(_turns(WeightedLaneScheduler(WEIGHTS), 100))
+    assert picks == {"high": 60, "normal": 30, "replay": 10}
+
+
+def test_every_lane_gets_a_turn_in_each_round():
+    turns = _turns(WeightedLaneScheduler(WEIGHTS), 10 * sum(WEIGHTS.values()))
+    for i in range(0, len(turns), 10):
+        assert set(turns[i:i + 10]) == set(WEIGHTS)
+
+
+def test_picks_are_interleaved():
+    # Smooth round robin does not pick the same lane 6 times in a row
+    turns = _turns(WeightedLaneScheduler(WEIGHTS), 10)
+    assert max(len(list(g)) for _, g in itertools.groupby(turns)) < WEIGHTS["high"]
+
+
+def test_skipped_lanes_hand_over_their_share():
+    sched = WeightedLaneScheduler(WEIGHTS)
+    picks = collections.Counter(_turns(sched, 40, skip={"high"}))
+    assert picks == {"normal": 30, "replay": 10}
+
+
+def test_no_lane_left():
+    sched = WeightedLaneScheduler(WEIGHTS)
+    assert sched.next_lane(skip=set(WEIGHTS)) is None
+
+
+def test_lanes_without_weight_are_never_picked():
+    sched = WeightedLaneScheduler({"high": 1, "normal": 0})
+    assert set(_turns(sched, 5)) == {"high"}
+
+
+def test_poll_lanes_without_a_lane_to_poll(monkeypatch):
+    import sqs_data_consumer
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "LANE_QUEUE_NAMES", {"normal": "reliable_q"})
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "LANE_WEIGHTS", {"normal": 0})
+    monkeypatch.setattr(sqs_data_consumer, "get_q_url", lambda client, q: f"https://sqs/{q}")
+    p_stat = sqs_data_consumer.poll_lanes(context=None)
+    assert p_stat["polls"] == 0
+    assert p_stat["lane_msgs"] == {"normal": 0}
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from msg_envelope import EnvelopePacker, envelope_attrs, is_envelope, pack, to_record, unpack
+
+
+SQS_MAX_MSG_BYTES = 256 * 1024
+
+
+def _records(cnt, body_bytes=1000):
+    return [
+        {"id": f"r-{i}", "body": json.dumps({"n": i, "pad": "x" * body_bytes}), "attrs": {"store_id": f"{i % 4}"}}
+        for i in range(cnt)
+    ]
+
+
+def _to_event_record(body, record_cnt, msg_id="env-1"):
+    """ An envelope as the consumer receives it in an SQS event """
+    return {
+        "messageId": msg_id,
+        "receiptHandle": f"rh-{msg_id}",
+        "body": body,
+        "messageAttributes": {
+            k: {"stringValue": v["StringValue"], "dataType": v["DataType"]}
+            for k, v in envelope_attrs(record_cnt).items()
+        }
+    }
+
+
+def test_add_closes_the_envelope_before_it_overflows():
+    packer = EnvelopePacker(max_bytes=10 * 1024)
+    closed = []
+    for rec in _records(50):
+        body = packer.add(rec)
+        if body:
+            closed.append(body)
+    closed.append(packer.flush())
+    assert len(closed) > 1
+    assert all(len(b.encode("utf-8")) <= 10 * 1024 for b in closed)
+    assert sum(len(json.loads(b)["records"]) for b in closed) == 50
+
+
+def test_envelopes_fill_up_to_the_sqs_limit():
+    recs = _records(1000, body_bytes=2000)
+    envelopes = pack(recs)
+    for body, _ in envelopes:
+        size = len(body.encode("utf-8"))
+        assert size <= EnvelopePacker().max_bytes < SQS_MAX_MSG_BYTES
+    # Every envelope but the last is too full to take one more record
+    rec_bytes = len(json.dumps(recs[0])) + 2
+    assert all(len(body) + rec_bytes > EnvelopePacker().max_bytes for body, _ in envelopes[:-1])
+    assert sum(cnt for _, cnt in envelopes) == len(recs)
+
+
+def test_size_accounts_for_multi_byte_characters():
+    recs = [{"id": f"r-{i}", "body": "é" * 500, "attrs": {}} for i in range(100)]
+    for body, _ in pack(recs, max_bytes=8 * 1024):
+        assert len(body.encode("utf-8")) <= 8 * 1024
+
+
+def test_record_too_big_for_an_envelope_is_rejected():
+    with pytest.raises(ValueError):
+        EnvelopePacker(max_bytes=1024).add(_records(1, body_bytes=2000)[0])
+
+
+def test_flush_of_an_empty_packer():
+    packer = EnvelopePacker()
+    assert packer.flush() is None
+    assert len(packer) == 0
+
+
+def test_unpack_round_trip():
+    recs = _records(30)
+    (body, cnt), = pack(recs)
+    m = _to_event_record(body, cnt)
+    assert is_envelope(m["messageAttributes"])
+    unpacked = unpack(m)
+    assert [r["envelopeId"] for r in unpacked] == ["env-1"] * 30
+    assert [r["messageAttributes"]["store_id"]["stringValue"] for r in unpacked] == [r["attrs"]["store_id"] for r in recs]
+    assert [to_record(r) for r in unpacked] == recs
+
+
+def test_repack_failed_records_round_trip():
+    recs = _records(30)
+    (body, cnt), = pack(recs)
+    failed = [r for r in unpack(_to_event_record(body, cnt)) if int(r["recordId"][2:]) % 3 == 0]
+    (re_body, re_cnt), = pack([to_record(r) for r in failed])
+    assert re_cnt == len(failed) == 10
+    assert [to_record(r) for r in unpack(_to_event_record(re_body, re_cnt, "env-2"))] == recs[::3]
@@ -0,0 +1,55 @@
+import datetime
+import json
+
+import pytest
+
+from msg_ttl import is_expired, msg_age_secs
+
+
+NOW = 1600000000
+
+
+def _msg(body=None, **attrs):
+    return {
+        "body": json.dumps(body if body is not None else {}),
+        "messageAttributes": {k: {"stringValue": f"{v}", "dataType": "String"} for k, v in attrs.items()},
+    }
+
+
+def test_age_from_the_ts_attribute():
+    assert msg_age_secs(_msg(ts=NOW - 30), NOW) == 30
+
+
+@pytest.mark.parametrize("ts", ["", "not-a-number", "16e8x"])
+def test_age_falls_back_to_the_evnt_time(ts):
+    evnt_time = datetime.datetime.fromtimestamp(NOW - 45).isoformat()
+    assert msg_age_secs(_msg({"evnt_time": evnt_time}, ts=ts), NOW) == pytest.approx(45)
+
+
+@pytest.mark.parametrize("body", ["not json", json.dumps([1, 2]), json.dumps({"evnt_time": "yesterday"})])
+def test_unknown_age(body):
+    assert msg_age_secs({"body": body, "messageAttributes": {}}, NOW) is None
+
+
+def test_expired_past_its_ttl():
+    assert is_expired(_msg(ts=NOW - 61, ttl_secs=60), NOW)
+    assert not is_expired(_msg(ts=NOW - 60, ttl_secs=60), NOW)
+
+
+def test_the_default_ttl_applies_without_a_ttl_secs():
+    assert is_expired(_msg(ts=NOW - 61), NOW, default_ttl_secs=60)
+    assert not is_expired(_msg(ts=NOW - 61), NOW)
+
+
+@pytest.mark.parametrize("ttl", [0, -1])
+def test_a_ttl_of_0_or_less_never_expires(ttl):
+    assert not is_expired(_msg(ts=0, ttl_secs=ttl), NOW, default_ttl_secs=60)
+    assert not is_expired(_msg(ts=0), NOW, default_ttl_secs=ttl)
+
+
+def test_a_non_numeric_ttl_secs_falls_back_to_the_default():
+    assert is_expired(_msg(ts=NOW - 61, ttl_secs="soon"), NOW, default_ttl_secs=60)
+
+
+def test_messages_of_unknown_age_never_expire():
+    assert not is_expired({"body": "not json", "messageAttributes": {}}, NOW, default_ttl_secs=1)
@@ -0,0 +1,190 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import sqs_data_consumer
+from fault_injection import FaultInjector
+from msg_envelope import envelope_attrs, pack, unpack
+
+
+SQS_BATCH_SIZE = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+NOW = 1600000000
+
+
+class FakeSqs:
+    """ Keeps the sent batches per queue, Rejects the batches real SQS would reject """
+
+    def __init__(self):
+        self.sent = {}
+
+    def get_queue_url(self, QueueName):
+        return {"QueueUrl": QueueName}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        size = sum(
+            len(e["MessageBody"].encode("utf-8")) +
+            sum(len(k) + len(v["DataType"]) + len(v["StringValue"].encode("utf-8"))
+                for k, v in e["MessageAttributes"].items())
+            for e in Entries
+        )
+        if len(Entries) > SQS_BATCH_SIZE or size > SQS_MAX_BATCH_BYTES:
+            raise ClientError({"Error": {"Code": "AWS.SimpleQueueService.BatchRequestTooLong"}}, "SendMessageBatch")
+        self.sent.setdefault(QueueUrl, []).append(Entries)
+        return {"Successful": [{"Id": e["Id"]} for e in Entries]}
+
+    def entries(self, q_name):
+        return [e for batch in self.sent.get(q_name, []) for e in batch]
+
+    def record_cnt(self, q_name):
+        """ Records sent to the queue, Envelopes count with all their records """
+        return sum(int(e["MessageAttributes"].get("record_cnt", {}).get("StringValue", 1))
+                   for e in self.entries(q_name))
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    fake = FakeSqs()
+    monkeypatch.setattr(sqs_data_consumer, "sqs_client", fake)
+    monkeypatch.setattr(sqs_data_consumer, "Q_URLS", {})
+    monkeypatch.setattr(sqs_data_consumer, "SINK", None)
+    monkeypatch.setattr(sqs_data_consumer, "FAULTS", FaultInjector("consume", {"enabled": False}))
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "EXPIRED_QUEUE_NAME", "reliable_q_expired")
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "DEAD_LETTER_QUEUE_NAME", "reliable_q_dlq")
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "RETRY_QUEUE_NAME", "reliable_q_retry_1")
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "DEFAULT_MSG_TTL_SECS", 0)
+    return fake
+
+
+def _attrs(**attrs):
+    return {k: {"stringValue": f"{v}", "dataType": "String"} for k, v in attrs.items()}
+
+
+def _msg(msg_id, body=None, **attrs):
+    return {
+        "messageId": msg_id,
+        "receiptHandle": f"rh-{msg_id}",
+        "body": json.dumps(body or {"n": msg_id}),
+        "messageAttributes": _attrs(**attrs),
+    }
+
+
+def _envelopes(cnt, records_per_envelope=None, pad_bytes=0, **attrs):
+    """ Event records of `cnt` envelopes of records with the attributes `attrs`, Full ones by default """
+    recs = [
+        {"id": f"r-{i}", "body": json.dumps({"n": i, "pad": "x" * pad_bytes}), "attrs": dict(attrs)}
+        for i in range(cnt * (records_per_envelope or 1000))
+    ]
+    if records_per_envelope:
+        packed = [pack(recs[i:i + records_per_envelope])[0] for i in range(0, len(recs), records_per_envelope)]
+    else:
+        packed = pack(recs)[:cnt]
+    return [
+        {
+            "messageId": f"env-{i}",
+            "receiptHandle": f"rh-env-{i}",
+            "body": body,
+            "messageAttributes": {
+                k: {"stringValue": v["StringValue"], "dataType": v["DataType"]}
+                for k, v in envelope_attrs(record_cnt, {"shard": {"DataType": "Number", "StringValue": "0"}}).items()
+            },
+        }
+        for i, (body, record_cnt) in enumerate(packed)
+    ]
+
+
+def test_full_envelopes_are_shed_in_batches_sqs_accepts(sqs):
+    envelopes = _envelopes(5, pad_bytes=1000, store_id=1, ts=NOW - 600, ttl_secs=60)
+    assert sum(len(e["body"]) for e in envelopes) > SQS_MAX_BATCH_BYTES
+    records = sum(len(unpack(e)) for e in envelopes)
+    stat = sqs_data_consumer.process_msgs(envelopes)
+    assert stat["expired_msgs"] == records
+    assert stat["s_msgs"] == 0
+    assert stat["failed_msg_ids"] == []
+    assert sqs.record_cnt("reliable_q_expired") == records
+    assert len(sqs.sent["reliable_q_expired"]) >= 5
+
+
+def test_full_envelopes_of_poison_pills_go_to_the_dlq(sqs):
+    envelopes = _envelopes(3, pad_bytes=1000)
+    records = sum(len(unpack(e)) for e in envelopes)
+    stat = sqs_data_consumer.process_msgs(envelopes)
+    assert stat["poison_msgs"] == records
+    assert sqs.record_cnt("reliable_q_dlq") == records
+    assert {e["MessageAttributes"]["shard"]["StringValue"] for e in sqs.entries("reliable_q_dlq")} == {"0"}
+
+
+def test_failed_records_of_full_envelopes_are_repacked_for_retry(sqs, monkeypatch):
+    def flaky(m):
+        raise RuntimeError("downstream timeout")
+    monkeypatch.setattr(sqs_data_consumer, "process_msg", flaky)
+    envelopes = _envelopes(3, pad_bytes=1000, store_id=1)
+    records = sum(len(unpack(e)) for e in envelopes)
+    stat = sqs_data_consumer.process_msgs(envelopes)
+    assert stat["repacked_msgs"] == records
+    assert stat["failed_msg_ids"] == []
+    assert sqs.record_cnt("reliable_q_retry_1") == records
+
+
+def test_plain_messages_are_sent_in_batches_of_10(sqs):
+    stat = sqs_data_consumer.process_msgs([_msg(f"m-{i}", ts=NOW, ttl_secs=60) for i in range(25)])
+    assert stat["expired_msgs"] == 25
+    assert [len(b) for b in sqs.sent["reliable_q_expired"]] == [10, 10, 5]
+
+
+def test_malformed_envelope_does_not_count_against_the_processed(sqs):
+    malformed = dict(_envelopes(1, records_per_envelope=2, store_id=1)[0], body="{not json")
+    good = _envelopes(1, records_per_envelope=2, store_id=1)[0]
+    stat = sqs_data_consumer.process_msgs([malformed, good])
+    assert stat["poison_msgs"] == 1
+    assert stat["s_msgs"] == 2
+    dead, = sqs.entries("reliable_q_dlq")
+    assert dead["MessageAttributes"]["error_reason"]["StringValue"] == "malformed_body"
+
+
+def test_nothing_is_shed_without_an_expired_queue(sqs, monkeypatch):
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "EXPIRED_QUEUE_NAME", None)
+    stat = sqs_data_consumer.process_msgs([_msg(f"m-{i}", store_id=1, ts=NOW, ttl_secs=60) for i in range(3)])
+    assert stat["expired_msgs"] == 0
+    assert stat["s_msgs"] == 3
+    assert sqs.sent == {}
+
+
+def test_a_non_numeric_ts_does_not_fail_the_batch(sqs):
+    stat = sqs_data_consumer.process_msgs([_msg("m-1", store_id=1, ts="n/a", ttl_secs=60), _msg("m-2", store_id=1)])
+    assert stat["s_msgs"] == 2
+
+
+def test_permanent_failures_are_dead_lettered_with_their_reason(sqs):
+    stat = sqs_data_consumer.process_msgs([
+        _msg("m-1", ts=NOW),
+        _msg("m-2", store_id=1),
+        dict(_msg("m-3", store_id=1), body="{not json"),
+    ])
+    assert stat["poison_msgs"] == 2
+    assert stat["s_msgs"] == 1
+    assert stat["failed_msg_ids"] == []
+    reasons = [e["MessageAttributes"]["error_reason"]["StringValue"] for e in sqs.entries("reliable_q_dlq")]
+    assert reasons == ["missing_store_id", "malformed_body"]
+
+
+def test_transient_failures_are_left_for_retry(sqs, monkeypatch):
+    process_msg = sqs_data_consumer.process_msg
+
+    def flaky(m):
+        if m["messageId"] == "m-2":
+            raise RuntimeError("downstream timeout")
+        return process_msg(m)
+    monkeypatch.setattr(sqs_data_consumer, "process_msg", flaky)
+    stat = sqs_data_consumer.process_msgs([_msg(f"m-{i}", store_id=1) for i in range(3)])
+    assert stat["failed_msg_ids"] == ["m-2"]
+    assert stat["s_msgs"] == 2
+    assert sqs.sent == {}
+
+
+def test_without_a_dlq_permanent_failures_are_retried(sqs, monkeypatch):
+    monkeypatch.setattr(sqs_data_consumer.GlobalArgs, "DEAD_LETTER_QUEUE_NAME", None)
+    stat = sqs_data_consumer.process_msgs([_msg("m-1"), _msg("m-2", store_id=1)])
+    assert stat["poison_msgs"] == 0
+    assert stat["failed_msg_ids"] == ["m-1"]
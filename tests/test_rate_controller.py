@@ -0,0 +1,85 @@
+import pytest
+
+import sqs_data_producer
+from sqs_data_producer import AimdRateController
+
+
+def _ctrl(**kw):
+    args = dict(target_backlog=100, min_rate=5, max_rate=50, incr_step=10, decr_factor=0.5)
+    args.update(kw)
+    return AimdRateController(**args)
+
+
+def test_starts_at_the_min_rate():
+    assert _ctrl().rate == 5
+
+
+def test_additive_increase_up_to_the_max_rate():
+    ctrl = _ctrl()
+    assert [ctrl.update(backlog=100) for _ in range(6)] == [15, 25, 35, 45, 50, 50]
+
+
+def test_multiplicative_decrease_down_to_the_min_rate():
+    ctrl = _ctrl()
+    for _ in range(10):
+        ctrl.update(backlog=0)
+    assert [ctrl.update(backlog=101) for _ in range(5)] == [25, 12.5, 6.25, 5, 5]
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = FakeClock()
+    monkeypatch.setattr(sqs_data_producer.time, "monotonic", c.monotonic)
+    monkeypatch.setattr(sqs_data_producer.time, "sleep", c.sleep)
+    return c
+
+
+def test_wait_paces_sends_at_the_rate(clock):
+    ctrl = _ctrl(min_rate=10)
+    for _ in range(11):
+        ctrl.wait(max_wait=5)
+    assert clock.now == pytest.approx(1001.0)
+
+
+def test_wait_never_blocks_past_max_wait(clock):
+    ctrl = _ctrl(min_rate=0.1)
+    ctrl.wait(max_wait=5)
+    ctrl.wait(max_wait=2)
+    assert clock.slept == [2]
+
+
+def test_idle_time_does_not_turn_into_a_burst(clock):
+    ctrl = _ctrl(min_rate=10)
+    ctrl.wait(max_wait=5)
+    clock.now += 60
+    for _ in range(3):
+        ctrl.wait(max_wait=5)
+    assert clock.slept == [pytest.approx(0.1), pytest.approx(0.1)]
+
+
+def test_backlog_of_envelopes_counts_their_records(monkeypatch):
+    monkeypatch.setattr(sqs_data_producer.GlobalArgs, "PACK_RECORDS", True)
+    monkeypatch.setattr(sqs_data_producer, "PACKED", {"envelopes": 0, "records": 0})
+    monkeypatch.setattr(sqs_data_producer, "send_msg", lambda *args: {"MessageId": "m-1"})
+    assert sqs_data_producer.records_per_msg() == 1
+    for record_cnt in (200, 100):
+        assert sqs_data_producer.send_packed(None, "https://sqs/q", "{}", record_cnt, {}) == 0
+    assert sqs_data_producer.records_per_msg() == 150
+    # 10 envelopes in flight are 1500 records, way past a target of 100
+    ctrl = _ctrl()
+    ctrl.update(backlog=10 * sqs_data_producer.records_per_msg())
+    assert ctrl.rate == 5
@@ -0,0 +1,71 @@
+import pytest
+
+import result_sinks
+from result_sinks import DynamoDbSink
+
+
+TABLE = "results"
+
+
+class FakeDynamoDb:
+    """ `batch_write_item` that leaves the items of `unprocessed` unprocessed, for each call in turn """
+
+    def __init__(self, *unprocessed):
+        self.unprocessed = list(unprocessed)
+        self.calls = []
+
+    def batch_write_item(self, RequestItems):
+        reqs = RequestItems[TABLE]
+        self.calls.append([r["PutRequest"]["Item"]["msg_id"]["S"] for r in reqs])
+        keep = set(self.unprocessed.pop(0)) if self.unprocessed else set()
+        left = [r for r in reqs if r["PutRequest"]["Item"]["msg_id"]["S"] in keep]
+        return {"UnprocessedItems": {TABLE: left} if left else {}}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(result_sinks.time, "sleep", lambda secs: None)
+
+
+def _put(sink, cnt):
+    for i in range(cnt):
+        sink.put(f"m-{i}", {"store_id": i})
+
+
+def test_chunks_of_25():
+    client = FakeDynamoDb()
+    sink = DynamoDbSink(TABLE, client=client)
+    _put(sink, 60)
+    assert sink.flush() == []
+    assert [len(c) for c in client.calls] == [25, 25, 10]
+
+
+def test_unprocessed_items_are_retried():
+    client = FakeDynamoDb(["m-1", "m-2"], ["m-2"])
+    sink = DynamoDbSink(TABLE, client=client, max_retries=3)
+    _put(sink, 5)
+    assert sink.flush() == []
+    assert client.calls[1:] == [["m-1", "m-2"], ["m-2"]]
+    assert sink.stat["retries"] == 2
+
+
+def test_items_left_after_the_retries_are_reported_as_failed():
+    client = FakeDynamoDb(["m-3"], ["m-3"], ["m-3"])
+    sink = DynamoDbSink(TABLE, client=client, max_retries=2)
+    _put(sink, 5)
+    assert sink.flush() == ["m-3"]
+    assert len(client.calls) == 3
+    assert sink.stat["failed"] == 1
+    # Reported once, The next flush starts clean
+    assert sink.flush() == []
+
+
+def test_client_errors_fail_the_whole_chunk():
+
+    class BrokenDynamoDb:
+        def batch_write_item(self, RequestItems):
+            raise RuntimeError("ProvisionedThroughputExceededException")
+
+    sink = DynamoDbSink(TABLE, client=BrokenDynamoDb())
+    _put(sink, 3)
+    assert sink.flush() == ["m-0", "m-1", "m-2"]
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import sqs_retry_with_backoff
+from fault_injection import FaultInjector
+
+
+DLQ = "reliable_q_dlq"
+
+
+class FakeSqs:
+
+    def __init__(self):
+        self.sent = []
+
+    def get_queue_url(self, QueueName):
+        return {"QueueUrl": f"{QueueName}"}
+
+    def send_message(self, **kw):
+        self.sent.append(kw)
+        return {"MessageId": f"m-{len(self.sent)}"}
+
+    def to(self, q_name):
+        return [m for m in self.sent if m["QueueUrl"] == q_name]
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    fake = FakeSqs()
+    monkeypatch.setattr(sqs_retry_with_backoff, "sqs_client", fake)
+    monkeypatch.setattr(sqs_retry_with_backoff, "Q_URLS", {})
+    monkeypatch.setattr(sqs_retry_with_backoff, "FAULTS", FaultInjector("replay", {"enabled": False}))
+    monkeypatch.setattr(sqs_retry_with_backoff.GlobalArgs, "DEAD_LETTER_QUEUE_NAME", DLQ)
+    monkeypatch.setattr(sqs_retry_with_backoff.GlobalArgs, "EXPIRED_QUEUE_NAME", None)
+    monkeypatch.setattr(sqs_retry_with_backoff.GlobalArgs, "MAX_ATTEMPTS", 3)
+    return fake
+
+
+def _record(**attrs):
+    return {
+        "messageId": "m-0",
+        "body": json.dumps({"n": 0}),
+        "messageAttributes": {
+            k: {"stringValue": f"{v}", "stringListValues": [], "binaryListValues": [], "dataType": "String"}
+            for k, v in attrs.items()
+        },
+    }
+
+
+def _handle(*records):
+    return sqs_retry_with_backoff.lambda_handler({"Records": list(records)}, None)
+
+
+def test_failed_messages_are_replayed_with_a_replay_count(sqs):
+    _handle(_record(store_id=1))
+    replayed, = sqs.sent
+    assert replayed["QueueUrl"] != DLQ
+    assert replayed["MessageAttributes"]["sqs-dlq-replay-cnt"]["StringValue"] == "1"
+    assert replayed["MessageAttributes"]["store_id"] == {"StringValue": "1", "DataType": "String"}
+
+
+def test_poison_pills_are_dead_lettered_with_their_error_reason(sqs):
+    _handle(_record(error_reason="missing_store_id"))
+    dead, = sqs.sent
+    assert dead["QueueUrl"] == DLQ
+    assert dead["MessageAttributes"]["error_reason"]["StringValue"] == "missing_store_id"
+
+
+def test_messages_past_max_attempts_are_dead_lettered(sqs):
+    _handle(_record(store_id=1, **{"sqs-dlq-replay-cnt": 3}))
+    dead, = sqs.sent
+    assert dead["QueueUrl"] == DLQ
+    assert dead["MessageAttributes"]["error_reason"]["StringValue"] == "max_attempts_exceeded"
+
+
+def test_without_a_dlq_max_attempts_fails_the_invocation(sqs, monkeypatch):
+    monkeypatch.setattr(sqs_retry_with_backoff.GlobalArgs, "DEAD_LETTER_QUEUE_NAME", None)
+    with pytest.raises(sqs_retry_with_backoff.MaxAttemptsError):
+        _handle(_record(store_id=1, **{"sqs-dlq-replay-cnt": 3}))
+    assert sqs.sent == []
+
+
+def test_the_backoff_stays_within_the_sqs_delay_limit(sqs, monkeypatch):
+    monkeypatch.setattr(sqs_retry_with_backoff.GlobalArgs, "MAX_ATTEMPTS", 20)
+    monkeypatch.setattr(sqs_retry_with_backoff.GlobalArgs, "BACKOFF_RATE", 1000)
+    monkeypatch.setattr(sqs_retry_with_backoff.random, "uniform", lambda lo, hi: hi)
+    _handle(_record(store_id=1, **{"sqs-dlq-replay-cnt": 10}))
+    replayed, = sqs.sent
+    assert replayed["DelaySeconds"] == 900
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import sqs_data_consumer
+import sqs_data_producer
+from msg_routing import shard_for
+
+
+LAYER_DIR = os.path.dirname(sys.modules["msg_routing"].__file__)
+
+
+def test_shard_of_known_keys():
+    # A change here moves stores to other shards, Their queued & in flight messages would be split
+    assert [shard_for(f"{store_id}", 4) for store_id in range(1, 9)] == [3, 1, 3, 0, 2, 0, 2, 3]
+
+
+@pytest.mark.parametrize("hash_seed", ["0", "1", "random"])
+def test_shard_is_stable_across_processes(hash_seed):
+    out = subprocess.check_output(
+        [sys.executable, "-c", "from msg_routing import shard_for; print([shard_for(str(k), 7) for k in range(50)])"],
+        env=dict(os.environ, PYTHONPATH=LAYER_DIR, PYTHONHASHSEED=hash_seed),
+    )
+    assert out.decode().strip() == str([shard_for(f"{k}", 7) for k in range(50)])
+
+
+@pytest.mark.parametrize("shard_cnt", [1, 2, 3, 8])
+def test_every_shard_is_in_range(shard_cnt):
+    assert {shard_for(f"{k}", shard_cnt) for k in range(1000)} == set(range(shard_cnt))
+
+
+def test_the_producer_routes_with_the_shared_shard_for():
+    assert sqs_data_producer.shard_for is shard_for
+
+
+def test_queue_urls_are_resolved_once(monkeypatch):
+    calls = []
+
+    class FakeSqs:
+        def get_queue_url(self, QueueName):
+            calls.append(QueueName)
+            return {"QueueUrl": f"https://sqs/{QueueName}"}
+
+    monkeypatch.setattr(sqs_data_consumer, "Q_URLS", {})
+    for _ in range(3):
+        assert sqs_data_consumer.get_q_url(FakeSqs(), "reliable_q_dlq_shard_1") == "https://sqs/reliable_q_dlq_shard_1"
+    assert calls == ["reliable_q_dlq_shard_1"]
@@ -0,0 +1,33 @@
+import topology_sim
+from topology_sim import TopologySim, shard_for, shard_shares
+from stacks.back_end.queue_topology import get_queue_topology
+
+
+def _sim(profile=None, **overrides):
+    return TopologySim(get_queue_topology(overrides), profile or {"enabled": False}, {"dist": "fixed", "ms": 5},
+                       {"dist": "fixed", "ms": 5}, seed=1)
+
+
+def test_a_ttl_of_0_never_expires():
+    resp = _sim(default_msg_ttl_secs=0, high_priority_msg_ttl_secs=0).run(2000, 50)
+    assert resp["stat"]["expired"] == 0
+    assert resp["stat"]["processed"] == 2000
+
+
+def test_shard_shares_follow_the_producer_hash():
+    shares = shard_shares(2, 4)
+    for shard in range(2):
+        assert shares[shard] == sum(shard_for(f"{s}", 2) == shard for s in range(1, 5)) / 4
+    assert abs(sum(shard_shares(4, 100, poison_pct=10)) - 1) < 1e-9
+
+
+def test_backoff_delays_stay_within_the_sqs_limit():
+    always_fail = {"enabled": True, "stages": {"consume": {"failure_pct": 100}}}
+    sim = _sim(always_fail, max_attempts=12, backoff_rate=2, max_msg_receive_cnt=1,
+               default_msg_ttl_secs=0, high_priority_msg_ttl_secs=0)
+    caps = []
+    uniform = sim.rng.uniform
+    sim.rng.uniform = lambda lo, hi: caps.append(hi) or uniform(lo, hi)
+    resp = sim.run(5, 1)
+    assert resp["stat"]["dlq"]["max_attempts"] == 5
+    assert max(caps) == topology_sim.GlobalArgs.MAX_DELAY_SECS
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+
+# Reuse the envelope format of the `pipeline_utils` lambda layer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "stacks", "back_end", "lambda_layers", "pipeline_utils", "python"))
+from msg_envelope import is_envelope, unpack  # noqa: E402
+
+
+"""
+.. module: dlq_archive
+    :Actions: Archive dead-letter queue messages into an indexed SQLite store for triage & re-injection
+    :copyright: (c) 2021 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "dlq_archive"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    DLQ_ARCHIVE_DB = os.getenv("DLQ_ARCHIVE_DB", "dlq_archive.db")
+    DEAD_LETTER_QUEUE_NAME = os.getenv(
+        "DEAD_LETTER_QUEUE_NAME", "reliable_q_dlq")
+    # SQS batch APIs take at most 10 messages
+    SQS_BATCH_SIZE = 10
+    # Attributes the envelope adds, They do not belong to the archived records
+    ENVELOPE_ATTRS = ("msg_fmt", "record_cnt")
+
+
+def set_logging(lv=GlobalArgs.LOG_LEVEL):
+    logging.basicConfig(level=lv)
+    logger = logging.getLogger()
+    logger.setLevel(lv)
+    return logger
+
+
+LOG = set_logging()
+
+
+# One row per failed record, Records of an envelope get a row each.
+#   `ts`        : When the record was produced(`ts` attribute)
+#   `failed_at` : When the message was sent to the DLQ(`SentTimestamp`), For redriven messages, when it was first sent
+#   `archived_at`, `reinjected_at` : Book keeping of this archive
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dlq_msgs (
+    msg_id        TEXT PRIMARY KEY,
+    envelope_id   TEXT,
+    queue_name    TEXT NOT NULL,
+    error_reason  TEXT,
+    store_id      TEXT,
+    shard         INTEGER,
+    priority      TEXT,
+    replay_cnt    INTEGER NOT NULL DEFAULT 0,
+    receive_cnt   INTEGER,
+    ts            INTEGER,
+    failed_at     INTEGER,
+    archived_at   INTEGER NOT NULL,
+    reinjected_at INTEGER,
+    body          TEXT NOT NULL,
+    attrs         TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_dlq_msgs_reason_failed_at ON dlq_msgs(error_reason, failed_at);
+CREATE INDEX IF NOT EXISTS idx_dlq_msgs_store_id_failed_at ON dlq_msgs(store_id, failed_at);
+CREATE INDEX IF NOT EXISTS idx_dlq_msgs_replay_cnt ON dlq_msgs(replay_cnt);
+CREATE INDEX IF NOT EXISTS idx_dlq_msgs_failed_at ON dlq_msgs(failed_at);
+CREATE INDEX IF NOT EXISTS idx_dlq_msgs_ts ON dlq_msgs(ts);
+"""
+
+# Columns `stats` can group by, Keep them indexed
+GROUP_BY_COLS = {
+    "reason": "error_reason",
+    "store_id": "store_id",
+    "replay_cnt": "replay_cnt",
+    "shard": "shard",
+    "queue": "queue_name",
+}
+
+
+def open_db(db_path=GlobalArgs.DLQ_ARCHIVE_DB):
+    db = sqlite3.connect(db_path)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    return db
+
+
+def get_sqs_client(region=None):
+    # Only draining & re-injection talk to SQS, Querying the archive works offline
+    import boto3
+    return boto3.client("sqs", region_name=region)
+
+
+def parse_since(since, now=None):
+    """ `30m`, `1h`, `2d` or epoch seconds, to epoch seconds """
+    if since is None:
+        return None
+    now = time.time() if now is None else now
+    m = re.fullmatch(r"(\d+)([smhd])", since)
+    if not m:
+        return int(since)
+    return int(now - int(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)])
+
+
+def _to_int(v):
+    try:
+        return int(float(v))
+    except (TypeError, ValueError):
+        return None
+
+
+def _flat_attrs(m_attr):
+    """ Message attributes of either shape(`stringValue`/`StringValue`), to `{name: value}` """
+    return {
+        k: v.get("stringValue", v.get("StringValue"))
+        for k, v in (m_attr or {}).items()
+        if v.get("stringValue", v.get("StringValue")) is not None
+    }
+
+
+def to_rows(q_name, m, archived_at=None):
+    """ Archive rows for the message `m`(`receive_message` shape), One per record for envelopes """
+    archived_at = int(time.time()) if archived_at is None else archived_at
+    sqs_attr = m.get("Attributes", {})
+    # Shape it like an event record, so `msg_envelope` can unpack it
+    evnt = {
+        "messageId": m["MessageId"],
+        "body": m["Body"],
+        "messageAttributes": {
+            k: {"stringValue": v.get("StringValue"), "dataType": v.get("DataType")}
+            for k, v in m.get("MessageAttributes", {}).items()
+        }
+    }
+    records = [evnt]
+    if is_envelope(evnt["messageAttributes"]):
+        try:
+            records = unpack(evnt)
+        except (ValueError, KeyError, TypeError):
+            # A malformed envelope is archived as it is
+            LOG.warning(f'{{"malformed_envelope":"{m["MessageId"]}"}}')
+    rows = []
+    for r in records:
+        attrs = {}
+        if "envelopeId" in r:
+            # Records inherit the envelope attributes like `shard` & `sqs-dlq-replay-cnt`
+            attrs = {k: v for k, v in _flat_attrs(r["envelopeAttributes"]).items()
+                     if k not in GlobalArgs.ENVELOPE_ATTRS}
+        attrs.update(_flat_attrs(r["messageAttributes"]))
+        rows.append({
+            "msg_id": r["messageId"],
+            "envelope_id": r.get("envelopeId"),
+            "queue_name": q_name,
+            "error_reason": attrs.get("error_reason"),
+            "store_id": attrs.get("store_id"),
+            "shard": _to_int(attrs.get("shard")),
+            "priority": attrs.get("priority"),
+            "replay_cnt": _to_int(attrs.get("sqs-dlq-replay-cnt")) or 0,
+            "receive_cnt": _to_int(sqs_attr.get("ApproximateReceiveCount")),
+            "ts": _to_int(attrs.get("ts")),
+            "failed_at": (_to_int(sqs_attr.get("SentTimestamp")) or archived_at * 1000) // 1000,
+            "archived_at": archived_at,
+            "body": r["body"],
+            "attrs": json.dumps(attrs),
+        })
+    return rows
+
+
+def archive_rows(db, rows):
+    """ Idempotent, A message received twice before its deletion is archived once """
+    cols = list(rows[0].keys()) if rows else []
+    with db:
+        cur = db.executemany(
+            f"INSERT OR IGNORE INTO dlq_msgs ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            [tuple(r[c] for c in cols) for r in rows]
+        )
+    return cur.rowcount if rows else 0
+
+
+def drain(db, sqs_client, q_name, max_msgs=None, delete=True, wait_secs=1):
+    """
+    Move the messages of the queue `q_name` into the archive.
+
+    Messages are deleted only after their rows are committed. Without
+    `delete`, received messages turn visible again after their visibility
+    timeout & are received over & over, so the pass stops at the first batch
+    holding only messages it has seen already.
+    """
+    stat = {"queue_name": q_name, "msgs": 0, "rows": 0, "deleted": 0}
+    q_url = sqs_client.get_queue_url(QueueName=q_name)["QueueUrl"]
+    seen_ids = set()
+    while max_msgs is None or stat["msgs"] < max_msgs:
+        n = GlobalArgs.SQS_BATCH_SIZE
+        if max_msgs is not None:
+            n = min(n, max_msgs - stat["msgs"])
+        msgs = sqs_client.receive_message(
+            QueueUrl=q_url,
+            MaxNumberOfMessages=n,
+            WaitTimeSeconds=wait_secs,
+            AttributeNames=["SentTimestamp", "ApproximateReceiveCount"],
+            MessageAttributeNames=["All"]
+        ).get("Messages", [])
+        if not msgs:
+            break
+        if not delete:
+            msgs = [m for m in msgs if m["MessageId"] not in seen_ids]
+            if not msgs:
+                break
+            seen_ids.update(m["MessageId"] for m in msgs)
+        rows = [row for m in msgs for row in to_rows(q_name, m)]
+        stat["rows"] += archive_rows(db, rows)
+        stat["msgs"] += len(msgs)
+        if delete:
+            resp = sqs_client.delete_message_batch(
+                QueueUrl=q_url,
+                Entries=[{"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]}
+                         for i, m in enumerate(msgs)]
+            )
+            stat["deleted"] += len(resp.get("Successful", []))
+    LOG.info(f'{{"drain_stat":{json.dumps(stat)}}}')
+    return stat
+
+
+def _where(reason=None, store_id=None, since=None, min_replay_cnt=None, queue_name=None, shard=None,
+           pending_only=False):
+    clauses, params = [], []
+    if reason is not None:
+        clauses.append("error_reason = ?")
+        params.append(reason)
+    if store_id is not None:
+        clauses.append("store_id = ?")
+        params.append(store_id)
+    if since is not None:
+        clauses.append("failed_at >= ?")
+        params.append(since)
+    if min_replay_cnt is not None:
+        clauses.append("replay_cnt >= ?")
+        params.append(min_replay_cnt)
+    if queue_name is not None:
+        clauses.append("queue_name = ?")
+        params.append(queue_name)
+    if shard is not None:
+        clauses.append("shard = ?")
+        params.append(shard)
+    if pending_only:
+        clauses.append("reinjected_at IS NULL")
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def stats(db, group_by="reason", **filters):
+    """ Failure counts per `group_by`, Most failures first """
+    col = GROUP_BY_COLS[group_by]
+    where, params = _where(**filters)
+    return [
+        (r[0], r[1]) for r in db.execute(
+            f"SELECT {col}, COUNT(*) FROM dlq_msgs{where} GROUP BY {col} ORDER BY 2 DESC, 1", params)
+    ]
+
+
+def find(db, limit=None, **filters):
+    where, params = _where(**filters)
+    sql = f"SELECT * FROM dlq_msgs{where} ORDER BY failed_at, msg_id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return db.execute(sql, params).fetchall()
+
+
+def reinject(db, sqs_client, q_name, rows, keep_error_reason=False, keep_ts=False):
+    """
+    Send the archived `rows` back as plain messages to `q_name`.
+
+    The `error_reason` is dropped, so the retry lambda replays the messages
+    instead of dead-lettering them again. The replay count is kept. The `ts`
+    is reset to now, or the messages would be past their `ttl_secs` & go
+    straight to the expired queue.
+    """
+    now = int(time.time())
+    stat = {"queue_name": q_name, "sent": 0, "failed": 0}
+    q_url = sqs_client.get_queue_url(QueueName=q_name)["QueueUrl"]
+    for i in range(0, len(rows), GlobalArgs.SQS_BATCH_SIZE):
+        batch = rows[i:i + GlobalArgs.SQS_BATCH_SIZE]
+        entries = []
+        for j, r in enumerate(batch):
+            attrs = json.loads(r["attrs"])
+            if not keep_error_reason:
+                attrs.pop("error_reason", None)
+            if not keep_ts and "ts" in attrs:
+                attrs["ts"] = f"{now}"
+            entries.append({
+                "Id": str(j),
+                "MessageBody": r["body"],
+                # The pipeline reads every attribute by its `stringValue`, So the original data types need not be kept
+                "MessageAttributes": {
+                    k: {"DataType": "String", "StringValue": v} for k, v in attrs.items()
+                }
+            })
+        resp = sqs_client.send_message_batch(QueueUrl=q_url, Entries=entries)
+        sent = [batch[int(e["Id"])]["msg_id"] for e in resp.get("Successful", [])]
+        for e in resp.get("Failed", []):
+            LOG.error(f'{{"reinject_failed":{json.dumps(e)}}}')
+        with db:
+            db.executemany(
+                "UPDATE dlq_msgs SET reinjected_at = ? WHERE msg_id = ?",
+                [(int(time.time()), m_id) for m_id in sent]
+            )
+        stat["sent"] += len(sent)
+        stat["failed"] += len(resp.get("Failed", []))
+    LOG.info(f'{{"reinject_stat":{json.dumps(stat)}}}')
+    return stat
+
+
+def _add_filter_args(p):
+    p.add_argument("--reason", help="Only messages with this error_reason")
+    p.add_argument("--store-id", help="Only messages of this store_id")
+    p.add_argument("--since", help="Only messages failed since, `30m`, `1h`, `2d` or epoch seconds")
+    p.add_argument("--min-replay-cnt", type=int, help="Only messages replayed at least this many times")
+    p.add_argument("--queue-name", help="Only messages archived from this queue")
+    p.add_argument("--shard", type=int, help="Only messages of this shard")
+
+
+def _filters(args, pending_only=False):
+    return {
+        "reason": args.reason,
+        "store_id": args.store_id,
+        "since": parse_since(args.since),
+        "min_replay_cnt": args.min_replay_cnt,
+        "queue_name": args.queue_name,
+        "shard": args.shard,
+        "pending_only": pending_only,
+    }
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Archive, query & re-inject dead-letter queue messages")
+    parser.add_argument("--db", default=GlobalArgs.DLQ_ARCHIVE_DB,
+                        help="SQLite archive file")
+    parser.add_argument("--region", help="AWS region of the queues")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.required = True
+
+    p = sub.add_parser("drain", help="Move the DLQ messages into the archive")
+    p.add_argument("--queue", action="append",
+                   help="Queue to drain, Repeat for every shard(default: %s)" % GlobalArgs.DEAD_LETTER_QUEUE_NAME)
+    p.add_argument("--max-msgs", type=int, help="Stop after this many messages per queue")
+    p.add_argument("--keep", action="store_true", help="Archive without deleting the messages")
+
+    p = sub.add_parser("stats", help="Count the failures, e.g. by reason in the last hour")
+    p.add_argument("--by", choices=sorted(GROUP_BY_COLS), default="reason")
+    _add_filter_args(p)
+
+    p = sub.add_parser("list", help="Print the matching messages as json lines")
+    p.add_argument("--limit", type=int, default=100)
+    _add_filter_args(p)
+
+    p = sub.add_parser("reinject", help="Send the matching messages back to a queue")
+    p.add_argument("--to", required=True, help="Queue to send to, e.g. reliable_q_replay")
+    p.add_argument("--limit", type=int, help="Re-inject at most this many messages")
+    p.add_argument("--again", action="store_true", help="Include the messages re-injected before")
+    p.add_argument("--keep-error-reason", action="store_true",
+                   help="Keep the error_reason, The retry lambda then dead-letters them again")
+    p.add_argument("--keep-ts", action="store_true",
+                   help="Keep the original ts, Messages past their ttl_secs are then expired again")
+    p.add_argument("--dry-run", action="store_true", help="Only count the matching messages")
+    _add_filter_args(p)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    db = open_db(args.db)
+    if args.cmd == "drain":
+        sqs_client = get_sqs_client(args.region)
+        for q_name in args.queue or [GlobalArgs.DEAD_LETTER_QUEUE_NAME]:
+            print(json.dumps(drain(db, sqs_client, q_name, max_msgs=args.max_msgs, delete=not args.keep)))
+    elif args.cmd == "stats":
+        for k, cnt in stats(db, group_by=args.by, **_filters(args)):
+            print(f"{cnt:>10}  {k}")
+    elif args.cmd == "list":
+        for r in find(db, limit=args.limit, **_filters(args)):
+            print(json.dumps(dict(r)))
+    elif args.cmd == "reinject":
+        rows = find(db, limit=args.limit, **_filters(args, pending_only=not args.again))
+        if args.dry_run:
+            print(json.dumps({"matching_msgs": len(rows)}))
+        else:
+            print(json.dumps(reinject(db, get_sqs_client(args.region), args.to, rows,
+                                      keep_error_reason=args.keep_error_reason, keep_ts=args.keep_ts)))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
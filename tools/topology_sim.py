@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import sys
+import time
+from array import array
+
+# Read the same configuration as the stacks: the `queue_topology` & `fault_injection` context in `cdk.json`
+# Share the routing & fault injection code of the lambdas, through their `pipeline_utils` layer
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "stacks", "back_end",
+                                "lambda_layers", "pipeline_utils", "python"))
+from fault_injection import FaultInjector  # noqa: E402
+from msg_routing import WeightedLaneScheduler, shard_for  # noqa: E402
+from stacks.back_end.queue_topology import get_queue_topology  # noqa: E402
+
+
+"""
+.. module: topology_sim
+    :Actions: Discrete-event simulation of the queue topology for capacity planning
+    :copyright: (c) 2021 Mystique.,
+.. moduleauthor:: Mystique
+.. contactauthor:: miztiik@github issues
+"""
+
+
+__author__ = "Mystique"
+__email__ = "miztiik@github"
+__version__ = "0.0.1"
+__status__ = "production"
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    ENVIRONMENT = "production"
+    MODULE_NAME = "topology_sim"
+    CDK_JSON = os.path.join(REPO_DIR, "cdk.json")
+    # Mirrors `sqs_data_consumer.GlobalArgs`
+    IDLE_WAIT_SECS = 2
+    MIN_REMAINING_TIME_MS = 3000
+    # SQS caps `DelaySeconds` at 15 minutes
+    MAX_DELAY_SECS = 900
+    SQS_BATCH_SIZE = 10
+    # `BatchWriteItem` of the result sink
+    SINK_BATCH_SIZE = 25
+
+
+# Fields of a simulated message, A list is cheaper than an object for millions of them
+BORN, LANE, RECV_CNT, REPLAY_CNT, TTL, POISON = range(6)
+INF = float("inf")
+
+
+def load_config(cdk_json=GlobalArgs.CDK_JSON):
+    """ The topology, the fault injection profile, the shard count & the store count from the `cdk.json` context """
+    with open(cdk_json) as f:
+        ctx = json.load(f).get("context", {})
+    return (
+        get_queue_topology(ctx.get("queue_topology")),
+        ctx.get("fault_injection") or {},
+        int(ctx.get("shard_cnt") or 1),
+        int(ctx.get("store_cnt") or 100)
+    )
+
+
+def shard_shares(shard_cnt, store_cnt, poison_pct=0):
+    """
+    Share of the traffic each shard gets from the producer. Stores(`store_id`
+    1 to `store_cnt`) are equally busy & stay on one shard, poison pills have
+    no `store_id` & are routed by a random key, so they spread evenly.
+    """
+    stores = [0] * shard_cnt
+    for store_id in range(1, store_cnt + 1):
+        stores[shard_for(f"{store_id}", shard_cnt)] += 1
+    p = poison_pct / 100
+    return [(1 - p) * cnt / store_cnt + p / shard_cnt for cnt in stores]
+
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return None
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * pct / 100))]
+
+
+class TopologySim:
+    """
+    Simulate one shard: the priority lanes, the retry queue & the DLQ, the
+    event source consumer, the scheduled lane polling consumer & the retry
+    lambda.
+
+    Queues are heaps keyed by the time a message turns visible, so delivery
+    delays, visibility timeouts & backoff delays need no events of their own.
+    The consumers & the retry lambda are the only processes, each one runs a
+    receive-process-delete step at a time, whichever is due first.
+    Every API call takes `api_ms`, Failures follow the `consume` & `replay`
+    stages of the fault injection profile & poison pills its `produce` stage.
+    """
+
+    def __init__(self, topology, profile, proc, retry_proc, api_ms=15, seed=None):
+        self.topo = topology
+        self.rng = random.Random(seed)
+        profile = dict(profile, seed=seed)
+        self.produce_faults = FaultInjector("produce", profile)
+        self.consume_faults = FaultInjector("consume", profile)
+        self.replay_faults = FaultInjector("replay", profile)
+        self.proc = proc
+        self.retry_proc = retry_proc
+        self.api_s = api_ms / 1000
+        self.lanes = {l: [] for l in ("high", "normal", "replay")}
+        self.retry_q = []
+        self._seq = 0
+        self.calls = dict.fromkeys([
+            "SendMessage", "SendMessageBatch", "ReceiveMessage", "EmptyReceive",
+            "DeleteMessageBatch", "DeleteMessage", "BatchWriteItem", "LambdaInvoke"], 0)
+        self.stat = {
+            "produced": 0, "processed": 0, "expired": 0, "consumer_failures": 0,
+            "consumer_timeouts": 0, "redriven_to_retry": 0, "replayed": 0,
+            "replay_failures": 0, "dlq": {"poison": 0, "max_attempts": 0, "retry_redrive": 0},
+            "consumer_busy_secs": 0.0, "event_consumer_busy_secs": 0.0, "max_open_msgs": 0
+        }
+        self.latency = {"high": array("d"), "normal": array("d")}
+        self.open_msgs = 0
+        self.last_done = 0.0
+
+    def _push(self, heap, visible_at, m):
+        self._seq += 1
+        heapq.heappush(heap, (visible_at, self._seq, m))
+
+    def _draw_ms(self, dist):
+        return max(0, FaultInjector.LATENCY_DISTS[dist["dist"]](self.rng, dist)) if dist else 0
+
+    def _fails(self, faults):
+        cfg = faults.cfg
+        pct = cfg.get("failure_pct", 0) + cfg.get("throttle_pct", 0)
+        return pct > 0 and self.rng.random() * 100 < pct
+
+    def _arrivals(self, n_msgs, rate):
+        """ Poisson arrivals, Producer sends one message per record """
+        t = 0.0
+        high_pct = self.topo["high_priority_pct"]
+        for _ in range(n_msgs):
+            t += self.rng.expovariate(rate)
+            high = self.rng.random() * 100 < high_pct
+            yield t, [t, "high" if high else "normal", 0, 0,
+                      self.topo["high_priority_msg_ttl_secs"] if high else self.topo["default_msg_ttl_secs"],
+                      self.produce_faults.bad_msg()]
+
+    def _admit(self, until):
+        delays = self.topo["delivery_delay_secs"]
+        while self._next_arrival is not None and self._next_arrival[0] <= until:
+            t, m = self._next_arrival
+            self._push(self.lanes[m[LANE]], t + delays[m[LANE]], m)
+            self.calls["SendMessage"] += 1
+            self.stat["produced"] += 1
+            self.open_msgs += 1
+            self._next_arrival = next(self._arrival_gen, None)
+        if self.open_msgs > self.stat["max_open_msgs"]:
+            self.stat["max_open_msgs"] = self.open_msgs
+
+    def _dead_letter(self, reason, n=1):
+        self.stat["dlq"][reason] += n
+        self.open_msgs -= n
+
+    def _receive(self, heap, t, max_msgs, max_recv_cnt, on_redrive):
+        """ Pop the visible messages, Those received too often are redriven instead, like SQS does """
+        batch = []
+        while heap and heap[0][0] <= t and len(batch) < max_msgs:
+            m = heapq.heappop(heap)[2]
+            if m[RECV_CNT] >= max_recv_cnt:
+                on_redrive(m, t)
+                continue
+            m[RECV_CNT] += 1
+            batch.append(m)
+        return batch
+
+    def _redrive_to_retry(self, m, t):
+        self.stat["redriven_to_retry"] += 1
+        m[RECV_CNT] = 0
+        self._push(self.retry_q, t, m)
+        # Wake up the retry lambda, unless it is busy with an invocation
+        if self._retry_waiting:
+            self.retry_t = min(self.retry_t, t)
+
+    def _redrive_to_dlq(self, m, t):
+        self._dead_letter("retry_redrive")
+
+    def _send_batches(self, n):
+        calls = math.ceil(n / GlobalArgs.SQS_BATCH_SIZE)
+        self.calls["SendMessageBatch"] += calls
+        return calls * self.api_s
+
+    def _process_batch(self, heap, batch, t_recv, timeout_at):
+        """ Process, sink & delete a received batch like `process_msgs`, Returns when it is done & if it timed out """
+        topo = self.topo
+        t = t_recv + self.api_s
+        ok, failed, expired, poison = [], [], [], []
+        for m in batch:
+            if m[TTL] > 0 and t - m[BORN] > m[TTL]:
+                expired.append(m)
+                continue
+            t += self.consume_faults.latency_ms() / 1000
+            if self._fails(self.consume_faults):
+                failed.append(m)
+            elif m[POISON]:
+                poison.append(m)
+            else:
+                t += self._draw_ms(self.proc) / 1000
+                ok.append(m)
+        if expired:
+            t += self._send_batches(len(expired))
+        if poison:
+            t += self._send_batches(len(poison))
+        if ok:
+            writes = math.ceil(len(ok) / GlobalArgs.SINK_BATCH_SIZE)
+            self.calls["BatchWriteItem"] += writes
+            t += writes * self.api_s
+        if len(batch) > len(failed):
+            self.calls["DeleteMessageBatch"] += 1
+            t += self.api_s
+        vis = topo["visibility_timeout_secs"]
+        if t > timeout_at:
+            # Killed by the lambda timeout, Nothing was deleted, The whole batch turns visible again
+            self.stat["consumer_timeouts"] += 1
+            for m in batch:
+                self._push(heap, t_recv + vis, m)
+            return t, True
+        for m in failed:
+            self._push(heap, t_recv + vis, m)
+        self.stat["consumer_failures"] += len(failed)
+        self.stat["expired"] += len(expired)
+        self._dead_letter("poison", len(poison))
+        for m in ok:
+            self.latency[m[LANE]].append(t - m[BORN])
+        self.stat["processed"] += len(ok)
+        self.open_msgs -= len(ok) + len(expired)
+        self.last_done = max(self.last_done, t)
+        return t, False
+
+    def event_step(self):
+        """ The lambda event source of the latency sensitive lanes, Invoked as soon as a message turns visible """
+        topo = self.topo
+        now = self.event_t
+        self._admit(now)
+        heaps = [self.lanes[l] for l in self._event_lanes]
+        visible = [h for h in heaps if h and h[0][0] <= now]
+        if not visible:
+            self.event_t = min([h[0][0] for h in heaps if h] +
+                               [self._next_arrival[0] if self._next_arrival else INF])
+            self._event_waiting = True
+            return
+        self._event_waiting = False
+        heap = min(visible, key=lambda h: h[0][0])
+        self.calls["ReceiveMessage"] += 1
+        batch = self._receive(heap, now, topo["consumer_batch_size"],
+                              topo["max_msg_receive_cnt"], self._redrive_to_retry)
+        if not batch:
+            return
+        self.calls["LambdaInvoke"] += 1
+        # SQS event sources need the function timeout within the visibility timeout
+        t, _ = self._process_batch(heap, batch, now, now + topo["visibility_timeout_secs"])
+        self.stat["event_consumer_busy_secs"] += t - now
+        self.event_t = t
+
+    def consumer_step(self):
+        topo = self.topo
+        now = self.consumer_t
+        period = topo["consumer_schedule_mins"] * 60
+        start = math.floor(now / period) * period
+        timeout_at = start + topo["consumer_timeout_secs"]
+        # The scheduled invocation stops polling when it runs low on time, A new one starts next period
+        if now >= timeout_at - GlobalArgs.MIN_REMAINING_TIME_MS / 1000:
+            self.consumer_t = start + period
+            self._sched, self._idle = None, set()
+            return
+        if self._sched is None:
+            self._sched = WeightedLaneScheduler(
+                {l: w for l, w in topo["lane_weights"].items() if l not in self._event_lanes})
+            if not self._sched.weights:
+                self.consumer_t = INF
+                return
+            self._top_lane = max(self._sched.weights, key=self._sched.weights.get)
+        lane = self._sched.next_lane(skip=self._idle)
+        wait = 0
+        if lane is None:
+            self._idle.clear()
+            lane = self._top_lane
+            wait = GlobalArgs.IDLE_WAIT_SECS
+        self._admit(now + wait)
+        heap = self.lanes[lane]
+        t_recv = now
+        # Long poll returns as soon as a message turns visible
+        if wait:
+            t_recv = min(now + wait, max(now, heap[0][0])) if heap else now + wait
+        self.calls["ReceiveMessage"] += 1
+        batch = self._receive(heap, t_recv, topo["consumer_batch_size"],
+                              topo["max_msg_receive_cnt"], self._redrive_to_retry)
+        if not batch:
+            self.calls["EmptyReceive"] += 1
+            self._idle.add(lane)
+            self.consumer_t = t_recv + self.api_s
+            return
+        t, timed_out = self._process_batch(heap, batch, t_recv, timeout_at)
+        self.stat["consumer_busy_secs"] += t - t_recv
+        if timed_out:
+            self.consumer_t = start + period
+            self._sched, self._idle = None, set()
+            return
+        self.consumer_t = t
+
+    def retry_step(self):
+        topo = self.topo
+        now = self.retry_t
+        heap = self.retry_q
+        # The lambda event source long polls, So it picks up a message as soon as it turns visible
+        if not heap or heap[0][0] > now:
+            self.retry_t = heap[0][0] if heap else INF
+            self._retry_waiting = True
+            return
+        self._retry_waiting = False
+        self.calls["ReceiveMessage"] += 1
+        batch = self._receive(heap, now, topo["retry_batch_size"],
+                              topo["max_msg_receive_cnt_at_retry"], self._redrive_to_dlq)
+        if not batch:
+            self.retry_t = heap[0][0] if heap else INF
+            self._retry_waiting = True
+            return
+        self.calls["LambdaInvoke"] += 1
+        t = now + self._draw_ms(self.retry_proc) / 1000 + self.replay_faults.latency_ms() / 1000
+        if self._fails(self.replay_faults):
+            # The invocation fails, The batch turns visible again after the visibility timeout
+            self.stat["replay_failures"] += len(batch)
+            for m in batch:
+                self._push(heap, now + topo["visibility_timeout_secs"], m)
+            self.retry_t = t
+            return
+        for m in batch:
+            t += self.api_s
+            self.calls["SendMessage"] += 1
+            if m[TTL] > 0 and t - m[BORN] > m[TTL]:
+                self.stat["expired"] += 1
+                self.open_msgs -= 1
+                continue
+            m[REPLAY_CNT] += 1
+            if m[REPLAY_CNT] > topo["max_attempts"]:
+                self._dead_letter("max_attempts")
+                continue
+            # `ExpoBackoffFullJitter` of the retry lambda
+            # Like the retry lambda, Full jitter under a cap SQS accepts as `DelaySeconds`
+            cap = min(GlobalArgs.MAX_DELAY_SECS, topo["message_retention_secs"],
+                      2 ** m[REPLAY_CNT] * topo["backoff_rate"])
+            delay = int(self.rng.uniform(0, cap))
+            m[RECV_CNT] = 0
+            self.stat["replayed"] += 1
+            self._push(self.lanes["replay"], t + delay, m)
+            # Wake up the event source consumer, unless it is busy with an invocation
+            if "replay" in self._event_lanes and self._event_waiting:
+                self.event_t = min(self.event_t, t + delay)
+        self.calls["DeleteMessage"] += 1
+        self.retry_t = t
+
+    def run(self, n_msgs, rate):
+        self._arrival_gen = self._arrivals(n_msgs, rate)
+        self._next_arrival = next(self._arrival_gen, None)
+        self._sched, self._idle = None, set()
+        self._event_lanes = set(self.topo["event_source_lanes"])
+        self.consumer_t, self.retry_t = 0.0, INF
+        self.event_t = 0.0 if self._event_lanes else INF
+        self._retry_waiting, self._event_waiting = True, True
+        while self._next_arrival is not None or self.open_msgs > 0:
+            t = min(self.event_t, self.consumer_t, self.retry_t)
+            if t == INF:
+                break
+            if self.event_t == t:
+                self.event_step()
+            elif self.consumer_t == t:
+                self.consumer_step()
+            else:
+                self.retry_step()
+        return self.report()
+
+    def report(self):
+        produced = self.stat["produced"] or 1
+        lat = {}
+        for p, vals in list(self.latency.items()) + [("all", self.latency["high"] + self.latency["normal"])]:
+            s = sorted(vals)
+            lat[p] = {f"p{q}": percentile(s, q) for q in (50, 90, 99, 99.9)}
+            lat[p]["max"] = s[-1] if s else None
+        dlq = sum(self.stat["dlq"].values())
+        return {
+            "sim_secs": self.last_done,
+            "throughput_msgs_per_sec": self.stat["processed"] / self.last_done if self.last_done else 0,
+            "consumer_utilization": self.stat["consumer_busy_secs"] / self.last_done if self.last_done else 0,
+            "event_consumer_utilization": self.stat["event_consumer_busy_secs"] / self.last_done if self.last_done else 0,
+            "latency_secs": lat,
+            "dlq_rate": dlq / produced,
+            "expired_rate": self.stat["expired"] / produced,
+            "api_calls": self.calls,
+            "api_calls_per_1k_msgs": {k: round(v * 1000 / produced, 2) for k, v in self.calls.items()},
+            "stat": self.stat,
+        }
+
+
+def _json_arg(s):
+    return json.loads(s) if s else None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Simulate the retry/DLQ topology of one shard, configured from cdk.json")
+    parser.add_argument("--cdk-json", default=GlobalArgs.CDK_JSON)
+    parser.add_argument("--msgs", type=int, default=100000, help="Messages to produce, across all the shards")
+    parser.add_argument("--rate", type=float, default=50, help="Messages per second, across all the shards")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--proc", type=_json_arg, default={"dist": "lognormal", "median_ms": 5, "sigma": 0.5},
+                        help="Processing time per message, a fault injection latency distribution")
+    parser.add_argument("--retry-proc", type=_json_arg, default={"dist": "fixed", "ms": 30},
+                        help="Processing time per retry lambda invocation")
+    parser.add_argument("--api-ms", type=float, default=15, help="Latency of every SQS & DynamoDB call")
+    parser.add_argument("--failure-pct", type=float, help="Overrides the `consume` stage failure_pct")
+    parser.add_argument("--replay-failure-pct", type=float, help="Overrides the `replay` stage failure_pct")
+    parser.add_argument("--poison-pct", type=float, help="Overrides the `produce` stage bad_msg_pct")
+    parser.add_argument("--set", action="append", default=[], metavar="KNOB=JSON",
+                        help="Override a queue_topology knob, e.g. --set max_attempts=5")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    topology, profile, shard_cnt, store_cnt = load_config(args.cdk_json)
+    topology = get_queue_topology(
+        {k: json.loads(v) for k, v in (s.split("=", 1) for s in args.set)}, base=topology)
+    profile = json.loads(json.dumps(profile))
+    stages = profile.setdefault("stages", {})
+    for stage, knob, v in [("consume", "failure_pct", args.failure_pct),
+                           ("replay", "failure_pct", args.replay_failure_pct),
+                           ("produce", "bad_msg_pct", args.poison_pct)]:
+        if v is not None:
+            profile["enabled"] = True
+            stages.setdefault(stage, {})[knob] = v
+    sim = TopologySim(topology, profile, args.proc, args.retry_proc, api_ms=args.api_ms, seed=args.seed)
+    # The hash of a few stores is lopsided, Size the topology for the busiest shard
+    poison_pct = stages.get("produce", {}).get("bad_msg_pct", 0) if profile.get("enabled", True) is True else 0
+    shares = shard_shares(shard_cnt, store_cnt, poison_pct)
+    share = max(shares)
+    started = time.monotonic()
+    resp = sim.run(math.ceil(args.msgs * share), args.rate * share)
+    resp["shard_cnt"] = shard_cnt
+    resp["store_cnt"] = store_cnt
+    resp["shard_shares"] = [round(s, 4) for s in shares]
+    resp["wall_secs"] = round(time.monotonic() - started, 2)
+    print(json.dumps(resp, indent=2))
+
+
+if __name__ == "__main__":
+    main()